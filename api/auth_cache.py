@@ -0,0 +1,106 @@
+# Authenticated-user cache: JWT subject -> read-only snapshot of the users row.
+#
+# get_current_user answers from here, so authenticated requests cost no DB
+# round trip while an entry is fresh. Writes to a user go through
+# invalidate() (or pin()/unpin() around a request that modifies the row),
+# so this process never serves a snapshot older than the last change it
+# made. Other API processes pick changes up within AUTH_CACHE_TTL.
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from database import User
+
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+# Never copied into snapshots
+_SECRET_FIELDS = frozenset({"hashed_password", "verification_token", "verification_token_expires"})
+_SNAPSHOT_FIELDS = tuple(c.name for c in User.__table__.columns if c.name not in _SECRET_FIELDS)
+
+
+class UserSnapshot:
+    """Read-only copy of a users row, shared between requests (no password hash or tokens)."""
+
+    __slots__ = _SNAPSHOT_FIELDS
+
+    def __init__(self, user: User):
+        for name in _SNAPSHOT_FIELDS:
+            object.__setattr__(self, name, getattr(user, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("UserSnapshot is read-only; modify the user through get_current_user_for_update")
+
+    def __repr__(self) -> str:
+        return f"<UserSnapshot id={self.id} email={self.email!r}>"
+
+
+class UserCache:
+    """Bounded LRU of subject -> (expires_at, UserSnapshot). Thread-safe (handlers run in the threadpool).
+
+    A snapshot loaded while an invalidation happened, or while its user is
+    pinned by an in-flight update, is not stored, so a concurrent reader can
+    never put a pre-update row back.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_size: int = AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, UserSnapshot]]" = OrderedDict()
+        self._pinned: Dict[int, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, subject: str) -> Optional[UserSnapshot]:
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[subject]
+                return None
+            self._entries.move_to_end(subject)
+            return entry[1]
+
+    def generation(self) -> int:
+        """Token to pass to put(); taken before the users row is read."""
+        return self._generation
+
+    def put(self, subject: str, user: User, generation: int) -> UserSnapshot:
+        snapshot = UserSnapshot(user)
+        if self.ttl <= 0:
+            return snapshot
+        with self._lock:
+            if generation != self._generation or snapshot.id in self._pinned:
+                return snapshot
+            self._entries[subject] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(subject)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id: int) -> None:
+        """Drop every snapshot of user_id (call after committing a change to the row)."""
+        with self._lock:
+            self._generation += 1
+            for subject in [s for s, (_, snap) in self._entries.items() if snap.id == user_id]:
+                del self._entries[subject]
+
+    def pin(self, user_id: int) -> None:
+        """Stop caching user_id until unpin(): the row is about to change."""
+        with self._lock:
+            self._pinned[user_id] = self._pinned.get(user_id, 0) + 1
+        self.invalidate(user_id)
+
+    def unpin(self, user_id: int) -> None:
+        with self._lock:
+            left = self._pinned.get(user_id, 1) - 1
+            if left > 0:
+                self._pinned[user_id] = left
+            else:
+                self._pinned.pop(user_id, None)
+        self.invalidate(user_id)
+
+
+user_cache = UserCache()
@@ -2,7 +2,8 @@
 from datetime import datetime
 from typing import Any
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+
+from usage_rollup import owner_requests_this_month
 
 PLAN_LIMITS = {
     "free": {"config_keys": 2, "requests_per_month": 500},
@@ -20,17 +21,9 @@ def get_effective_plan(user: Any) -> str:
 
 
 def get_requests_this_month(db: Session, owner_id: int) -> int:
-    first_day = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    # O(1): per-owner month counter maintained by usage_rollup, plus the unfolded tail
     try:
-        r = db.execute(
-            text(
-                "SELECT COUNT(*) FROM usage_log u "
-                "INNER JOIN config_api_keys c ON c.id = u.config_api_key_id AND c.owner_id = :oid "
-                "WHERE u.requested_at >= :fd"
-            ),
-            {"oid": owner_id, "fd": first_day},
-        ).fetchone()
-        return int(r[0]) if r and r[0] is not None else 0
+        return owner_requests_this_month(db, owner_id)
     except Exception:
         return 0
 
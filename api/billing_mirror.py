@@ -0,0 +1,390 @@
+# Local mirror of Stripe subscriptions and invoices, maintained from webhook events.
+#
+# The webhook only verifies the signature and stores the event in
+# stripe_events (keyed by the Stripe event id, so redeliveries are dropped),
+# then answers. A background worker applies stored events in Stripe order:
+# each upserts billing_subscriptions / billing_invoices and re-derives the
+# owner's plan. Every mirrored row remembers the Stripe time of its state and
+# ignores older events (same-second ties go to the later lifecycle status), so
+# applying an event twice or out of order is harmless. Billing pages read the
+# mirror and never call Stripe.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, List, Optional, Set
+
+from sqlalchemy import JSON, bindparam, or_, text
+from sqlalchemy.orm import Session
+
+from auth_cache import user_cache
+from database import BillingInvoice, BillingSubscription, SessionLocal, User
+
+logger = logging.getLogger(__name__)
+
+BILLING_EVENTS_INTERVAL = float(os.getenv("BILLING_EVENTS_INTERVAL", "5"))
+BILLING_EVENT_MAX_ATTEMPTS = int(os.getenv("BILLING_EVENT_MAX_ATTEMPTS", "10"))
+# Processed events are kept this long to drop redeliveries (Stripe retries for up to 3 days)
+BILLING_EVENTS_RETENTION_DAYS = int(os.getenv("BILLING_EVENTS_RETENTION_DAYS", "30"))
+BILLING_EVENTS_BATCH = 50
+STRIPE_PRO_PRICE_ID = os.getenv("STRIPE_PRO_PRICE_ID", "")
+
+# Subscription statuses that grant the paid plan, and those that take it away
+# (past_due / unpaid keep the plan while Stripe retries the payment)
+ACTIVE_STATUSES = ("active", "trialing")
+REVOKED_STATUSES = ("paused", "canceled", "incomplete_expired")
+
+# Event "created" has one-second resolution. Between two events of the same
+# second, a state is only replaced by one at least as far along its lifecycle
+SUBSCRIPTION_STATUS_ORDER = {
+    "incomplete": 0,
+    "trialing": 1,
+    "active": 2,
+    "past_due": 2,
+    "unpaid": 2,
+    "paused": 3,
+    "canceled": 4,
+    "incomplete_expired": 4,
+}
+INVOICE_STATUS_ORDER = {"draft": 0, "open": 1, "uncollectible": 2, "paid": 3, "void": 3, "deleted": 4}
+# Deleted (draft) invoices keep a tombstone row so a delayed older event cannot recreate them
+INVOICE_DELETED = "deleted"
+
+_INSERT_EVENT = text("""
+    INSERT INTO stripe_events (id, type, created, payload, received_at, attempts)
+    VALUES (:id, :type, :created, :payload, :received_at, 0)
+    ON DUPLICATE KEY UPDATE id = id
+""").bindparams(bindparam("payload", type_=JSON))
+
+# Pending events, oldest first; SKIP LOCKED lets several API processes share the queue
+_CLAIM_EVENTS = text("""
+    SELECT id, type, created, payload, attempts FROM stripe_events
+    WHERE processed_at IS NULL AND attempts < :max_attempts
+      AND (next_attempt_at IS NULL OR next_attempt_at <= :now)
+    ORDER BY created, received_at
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+""").columns(payload=JSON)
+
+
+def _timestamp(value: Any) -> Optional[datetime]:
+    return datetime.utcfromtimestamp(value) if isinstance(value, (int, float)) else None
+
+
+def _first_item(sub: Any) -> dict:
+    data = (sub.get("items") or {}).get("data") or []
+    return data[0] if data else {}
+
+
+def plan_for_price(price_id: str) -> str:
+    return "pro" if price_id == STRIPE_PRO_PRICE_ID else "starter"
+
+
+def _is_stale(row: Any, event_created: int, status: str, order: dict) -> bool:
+    """True if the mirrored row already holds a newer state than this event's."""
+    if row is None or row.event_created < event_created:
+        return False
+    if row.event_created > event_created:
+        return True
+    return order.get(status, 0) < order.get(row.status, 0)
+
+
+def store_event(db: Session, payload: bytes) -> None:
+    """Queue a verified webhook payload (no-op if this event id was already received)."""
+    event = json.loads(payload)
+    db.execute(_INSERT_EVENT, {
+        "id": event["id"],
+        "type": event["type"],
+        "created": event["created"],
+        "payload": event["data"]["object"],
+        "received_at": datetime.utcnow(),
+    })
+    db.commit()
+
+
+def apply_subscription(db: Session, sub: Any, event_created: int, deleted: bool = False) -> Optional[int]:
+    """Mirror one subscription; returns the id of the user whose plan changed, if any."""
+    status = "canceled" if deleted else (sub.get("status") or "")
+    row = db.get(BillingSubscription, sub["id"], with_for_update=True)
+    if _is_stale(row, event_created, status, SUBSCRIPTION_STATUS_ORDER):
+        return None  # an event newer than this one was already applied
+    if row is None:
+        row = BillingSubscription(id=sub["id"])
+        db.add(row)
+    item = _first_item(sub)
+    price = item.get("price")
+    price_id = (price.get("id") if isinstance(price, dict) else price) or ""
+    row.customer_id = sub.get("customer")
+    row.status = status
+    row.price_id = price_id or None
+    row.plan = plan_for_price(price_id)
+    row.cancel_at_period_end = bool(sub.get("cancel_at_period_end"))
+    # Newer API versions carry the period on the subscription item
+    row.current_period_end = _timestamp(sub.get("current_period_end") or item.get("current_period_end"))
+    row.created_at = _timestamp(sub.get("created"))
+    row.event_created = event_created
+    db.flush()
+    user = db.query(User).filter(User.stripe_customer_id == row.customer_id).first()
+    if user is not None and sync_user_plan(db, user):
+        return user.id
+    return None
+
+
+def apply_invoice(db: Session, inv: Any, event_created: int, deleted: bool = False) -> None:
+    status = INVOICE_DELETED if deleted else inv.get("status")
+    row = db.get(BillingInvoice, inv["id"], with_for_update=True)
+    if _is_stale(row, event_created, status or "", INVOICE_STATUS_ORDER):
+        return
+    if row is None:
+        row = BillingInvoice(id=inv["id"])
+        db.add(row)
+    row.customer_id = inv.get("customer")
+    row.subscription_id = inv.get("subscription")
+    row.number = inv.get("number")
+    row.status = status
+    row.amount_due = inv.get("amount_due") or 0
+    row.amount_paid = inv.get("amount_paid") or 0
+    row.currency = inv.get("currency")
+    row.created_at = _timestamp(inv.get("created"))
+    row.hosted_invoice_url = inv.get("hosted_invoice_url")
+    row.invoice_pdf = inv.get("invoice_pdf")
+    row.event_created = event_created
+
+
+def apply_event(db: Session, event_type: str, obj: Any, created: int) -> Optional[int]:
+    """Apply one stored event to the mirror; returns the id of a user whose plan changed."""
+    if event_type.startswith("customer.subscription."):
+        return apply_subscription(db, obj, created, deleted=event_type == "customer.subscription.deleted")
+    if event_type.startswith("invoice."):
+        apply_invoice(db, obj, created, deleted=event_type == "invoice.deleted")
+    # Other event types are recorded (for dedup) but not mirrored
+    return None
+
+
+def sync_user_plan(db: Session, user: User) -> bool:
+    """Set the user's subscription and plan from the mirror; True if the row changed.
+
+    The newest active or trialing subscription of the user's customer wins.
+    Without one, the plan is only taken away when the mirror shows the
+    current subscription ended, not merely because its events have not
+    arrived yet.
+    """
+    cid = getattr(user, "stripe_customer_id", None)
+    if not cid:
+        return False
+    sub = (
+        db.query(BillingSubscription)
+        .filter(BillingSubscription.customer_id == cid, BillingSubscription.status.in_(ACTIVE_STATUSES))
+        .order_by(BillingSubscription.created_at.desc())
+        .first()
+    )
+    if sub is not None:
+        sub_id, plan = sub.id, sub.plan
+    elif user.stripe_subscription_id:
+        current = db.get(BillingSubscription, user.stripe_subscription_id)
+        if current is None or current.status not in REVOKED_STATUSES:
+            return False
+        sub_id, plan = None, "free"
+    else:
+        return False
+    if (user.stripe_subscription_id, user.plan) == (sub_id, plan):
+        return False
+    user.stripe_subscription_id = sub_id
+    user.plan = plan
+    return True
+
+
+def process_events(db: Session, limit: int = BILLING_EVENTS_BATCH) -> int:
+    """Apply up to limit pending events in one transaction; returns how many were claimed."""
+    now = datetime.utcnow()
+    rows = db.execute(_CLAIM_EVENTS, {"max_attempts": BILLING_EVENT_MAX_ATTEMPTS, "now": now, "limit": limit}).fetchall()
+    changed_users: Set[int] = set()
+    for event_id, event_type, created, obj, attempts in rows:
+        try:
+            with db.begin_nested():
+                user_id = apply_event(db, event_type, obj, created)
+        except Exception as e:
+            attempts += 1
+            if attempts >= BILLING_EVENT_MAX_ATTEMPTS:
+                logger.error("Stripe event %s (%s) failed %d times, giving up: %s", event_id, event_type, attempts, e)
+            else:
+                logger.warning("Stripe event %s (%s) failed, will retry: %s", event_id, event_type, e)
+            db.execute(
+                text("""
+                    UPDATE stripe_events SET attempts = :attempts, last_error = :error, next_attempt_at = :next
+                    WHERE id = :id
+                """),
+                {
+                    "id": event_id,
+                    "attempts": attempts,
+                    "error": str(e)[:1000],
+                    "next": now + timedelta(seconds=min(3600, BILLING_EVENTS_INTERVAL * 2 ** attempts)),
+                },
+            )
+            continue
+        if user_id is not None:
+            changed_users.add(user_id)
+        db.execute(
+            text("UPDATE stripe_events SET processed_at = :now, attempts = :attempts, last_error = NULL WHERE id = :id"),
+            {"id": event_id, "now": now, "attempts": attempts + 1},
+        )
+    db.commit()
+    for user_id in changed_users:
+        user_cache.invalidate(user_id)
+    return len(rows)
+
+
+def prune_events(db: Session, retention_days: int = BILLING_EVENTS_RETENTION_DAYS) -> int:
+    """Delete processed events past the dedup window, and abandoned ones (attempts used up) as old.
+
+    Abandoned events are counted in /api/health until then (see failed_events).
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    processed = db.execute(
+        text("DELETE FROM stripe_events WHERE processed_at IS NOT NULL AND processed_at < :cutoff"),
+        {"cutoff": cutoff},
+    ).rowcount or 0
+    abandoned = db.execute(
+        text("""
+            DELETE FROM stripe_events
+            WHERE processed_at IS NULL AND attempts >= :max_attempts AND received_at < :cutoff
+        """),
+        {"cutoff": cutoff, "max_attempts": BILLING_EVENT_MAX_ATTEMPTS},
+    ).rowcount or 0
+    db.commit()
+    if abandoned:
+        logger.warning("Pruned %d Stripe events that were never applied", abandoned)
+    return processed + abandoned
+
+
+def failed_events(db: Session) -> int:
+    """Events that used up BILLING_EVENT_MAX_ATTEMPTS and are no longer retried."""
+    return db.execute(
+        text("SELECT COUNT(*) FROM stripe_events WHERE processed_at IS NULL AND attempts >= :max_attempts"),
+        {"max_attempts": BILLING_EVENT_MAX_ATTEMPTS},
+    ).scalar() or 0
+
+
+def customer_invoices(db: Session, customer_id: str, limit: int = 50) -> List[dict]:
+    """Newest invoices of a customer from the mirror, in the billing page's format."""
+    rows = (
+        db.query(BillingInvoice)
+        .filter(
+            BillingInvoice.customer_id == customer_id,
+            or_(BillingInvoice.status.is_(None), BillingInvoice.status != INVOICE_DELETED),
+        )
+        .order_by(BillingInvoice.created_at.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        {
+            "id": inv.id,
+            "number": inv.number,
+            "status": inv.status,
+            "amount_due": inv.amount_due,
+            "amount_paid": inv.amount_paid,
+            "currency": (inv.currency or "eur").upper(),
+            "created": inv.created_at.isoformat() + "Z" if inv.created_at else None,
+            "hosted_invoice_url": inv.hosted_invoice_url,
+            "invoice_pdf": inv.invoice_pdf,
+        }
+        for inv in rows
+    ]
+
+
+def _run_once(fn, *args):
+    db = SessionLocal()
+    try:
+        return fn(db, *args)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+class BillingEventWorker:
+    """Applies stored Stripe events in the background; the webhook calls wake() after storing one.
+
+    Also polls every BILLING_EVENTS_INTERVAL, which picks up events received
+    by other API processes and retries failed ones.
+    """
+
+    def __init__(self, interval: float = BILLING_EVENTS_INTERVAL):
+        self.interval = interval
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self) -> None:
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        next_prune = loop.time()
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed = await asyncio.to_thread(_run_once, process_events)
+            except Exception as e:
+                logger.warning("Stripe event processing failed: %s", e)
+                claimed = 0
+            if loop.time() >= next_prune:
+                next_prune = loop.time() + 3600
+                try:
+                    await asyncio.to_thread(_run_once, prune_events)
+                except Exception as e:
+                    logger.warning("Stripe event pruning failed: %s", e)
+            if claimed >= BILLING_EVENTS_BATCH:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+billing_events = BillingEventWorker()
+
+
+def backfill(db: Session, client) -> dict:
+    """Load every subscription and invoice from Stripe into the mirror (one-time, or to repair it).
+
+    Rows are stamped with the time of the listing, so events that were
+    already in flight and are older do not overwrite them.
+    """
+    now = int(time.time())
+    counts = {"subscriptions": 0, "invoices": 0, "users": 0}
+    for sub in client.subscriptions.list(params={"status": "all", "limit": 100}).auto_paging_iter():
+        if apply_subscription(db, sub, now) is not None:
+            counts["users"] += 1
+        counts["subscriptions"] += 1
+    db.commit()
+    for inv in client.invoices.list(params={"limit": 100}).auto_paging_iter():
+        apply_invoice(db, inv, now)
+        counts["invoices"] += 1
+    db.commit()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Billing mirror maintenance")
+    parser.add_argument("--backfill", action="store_true", help="Load all subscriptions and invoices from Stripe")
+    parser.add_argument("--process", action="store_true", help="Apply all pending webhook events now")
+    args = parser.parse_args()
+    if args.backfill:
+        import stripe
+
+        result = _run_once(backfill, stripe.StripeClient(os.environ["STRIPE_SECRET_KEY"]))
+        print(f"Mirrored {result['subscriptions']} subscriptions and {result['invoices']} invoices; {result['users']} user plans updated")
+    if args.process:
+        total = 0
+        while True:
+            claimed = _run_once(process_events)
+            total += claimed
+            if claimed < BILLING_EVENTS_BATCH:
+                break
+        print(f"Processed {total} Stripe events")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Send signed fake Stripe webhook events to the API (no Stripe account needed).
+Usage (from host, API running with STRIPE_WEBHOOK_SECRET set):
+  docker compose exec api python fake_stripe_events.py --email user@example.com [--url http://localhost:8000] [--cancel]
+The user gets a fake Stripe customer id if it has none. The scenario covers
+what the billing mirror must handle: a new subscription, an invoice, a
+redelivered event, an upgrade whose older "updated" event arrives last, and
+(with --cancel) the deletion. Then check the billing page or
+GET /api/billing/invoices and /api/billing/usage for that user.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sys
+import time
+
+import requests
+
+from database import SessionLocal, User
+
+
+def signature_header(payload: str, secret: str, timestamp: int) -> str:
+    """Stripe-Signature header value, as Stripe computes it."""
+    mac = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={mac}"
+
+
+def make_event(event_type: str, obj: dict, created: int) -> dict:
+    return {
+        "id": f"evt_fake_{secrets.token_hex(8)}",
+        "object": "event",
+        "type": event_type,
+        "created": created,
+        "livemode": False,
+        "data": {"object": obj},
+    }
+
+
+def subscription(sub_id: str, customer: str, price_id: str, status: str, created: int) -> dict:
+    return {
+        "id": sub_id,
+        "object": "subscription",
+        "customer": customer,
+        "status": status,
+        "created": created,
+        "cancel_at_period_end": False,
+        "current_period_end": created + 30 * 86400,
+        "items": {"object": "list", "data": [{"id": f"si_fake_{sub_id[-8:]}", "price": {"id": price_id}}]},
+    }
+
+
+def invoice(inv_id: str, customer: str, sub_id: str, status: str, amount: int, created: int) -> dict:
+    return {
+        "id": inv_id,
+        "object": "invoice",
+        "customer": customer,
+        "subscription": sub_id,
+        "number": f"FAKE-{inv_id[-6:].upper()}",
+        "status": status,
+        "amount_due": amount,
+        "amount_paid": amount if status == "paid" else 0,
+        "currency": "eur",
+        "created": created,
+        "hosted_invoice_url": None,
+        "invoice_pdf": None,
+    }
+
+
+def send(url: str, secret: str, event: dict) -> None:
+    payload = json.dumps(event)
+    r = requests.post(
+        url,
+        data=payload,
+        headers={"Content-Type": "application/json", "Stripe-Signature": signature_header(payload, secret, int(time.time()))},
+        timeout=10,
+    )
+    print(f"{event['type']:<40} {event['id']}  -> {r.status_code} {r.text.strip()}")
+    r.raise_for_status()
+
+
+def customer_for(email: str) -> str:
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == email).first()
+        if user is None:
+            sys.exit(f"No user with email {email}")
+        if not user.stripe_customer_id:
+            user.stripe_customer_id = f"cus_fake_{user.id}"
+            db.commit()
+            print(f"Linked {email} to fake customer {user.stripe_customer_id}")
+        return user.stripe_customer_id
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send signed fake Stripe webhook events")
+    parser.add_argument("--email", required=True, help="User the events belong to")
+    parser.add_argument("--url", default="http://localhost:8000", help="API base URL")
+    parser.add_argument("--secret", default=os.getenv("STRIPE_WEBHOOK_SECRET", ""), help="Webhook signing secret")
+    parser.add_argument("--cancel", action="store_true", help="End with customer.subscription.deleted")
+    args = parser.parse_args()
+    if not args.secret:
+        sys.exit("Set STRIPE_WEBHOOK_SECRET (the API must use the same value)")
+    url = args.url.rstrip("/") + "/api/billing/webhook"
+    starter = os.getenv("STRIPE_STARTER_PRICE_ID") or "price_fake_starter"
+    pro = os.getenv("STRIPE_PRO_PRICE_ID") or "price_fake_pro"
+
+    customer = customer_for(args.email)
+    now = int(time.time())
+    sub_id = f"sub_fake_{secrets.token_hex(6)}"
+    inv_id = f"in_fake_{secrets.token_hex(6)}"
+
+    created = make_event("customer.subscription.created", subscription(sub_id, customer, starter, "active", now), now)
+    send(url, args.secret, created)
+    send(url, args.secret, make_event("invoice.finalized", invoice(inv_id, customer, sub_id, "open", 1200, now), now + 1))
+    paid = make_event("invoice.paid", invoice(inv_id, customer, sub_id, "paid", 1200, now), now + 2)
+    send(url, args.secret, paid)
+    # Stripe redelivers until it gets a 2xx: must be stored once
+    send(url, args.secret, paid)
+    # Upgrade to Pro, delivered before an older update of the same subscription: Pro must stay
+    send(url, args.secret, make_event("customer.subscription.updated", subscription(sub_id, customer, pro, "active", now), now + 20))
+    send(url, args.secret, make_event("customer.subscription.updated", subscription(sub_id, customer, starter, "active", now), now + 10))
+    expected = "pro"
+    if args.cancel:
+        send(url, args.secret, make_event("customer.subscription.deleted", subscription(sub_id, customer, pro, "canceled", now), now + 30))
+        expected = "free"
+    print(f"Sent. Once processed, {args.email} should be on plan '{expected}' with 1 paid invoice ({inv_id}).")
+
+
+if __name__ == "__main__":
+    main()
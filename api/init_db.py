@@ -1,5 +1,6 @@
 from database import SessionLocal, User, Base, engine, ConfigApiKey, UsageLog, ContactRequest
 from passlib.context import CryptContext
+from usage_retention import list_partitions, maintain_usage_log
 from sqlalchemy import text
 import os
 import secrets
@@ -21,6 +22,12 @@ def run_migrations(db):
         ("max_latency", "INT DEFAULT 0"),
         ("method", "VARCHAR(20) DEFAULT 'ANY'"),
         ("error_codes", "JSON"),
+        ("bandwidth_kbps", "INT DEFAULT 0"),
+        ("bandwidth_jitter", "INT DEFAULT 0"),
+        ("latency_distribution", "VARCHAR(32) DEFAULT 'uniform'"),
+        ("latency_params", "JSON"),
+        ("chaos_seed", "BIGINT NULL"),
+        ("updated_at", "DATETIME NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
     ]:
         try:
             db.execute(text(f"ALTER TABLE config_api_keys ADD COLUMN {col} {spec}"))
@@ -63,12 +70,16 @@ def run_migrations(db):
     try:
         db.execute(text("""
             CREATE TABLE IF NOT EXISTS usage_log (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+                id BIGINT AUTO_INCREMENT,
                 config_api_key_id INT NOT NULL,
                 requested_at DATETIME NOT NULL,
+                injected_ms INT NULL,
+                upstream_ms INT NULL,
+                status_code SMALLINT NULL,
+                failed TINYINT(1) NOT NULL DEFAULT 0,
+                PRIMARY KEY (id, requested_at),
                 INDEX (config_api_key_id),
-                INDEX (requested_at),
-                FOREIGN KEY (config_api_key_id) REFERENCES config_api_keys(id) ON DELETE CASCADE
+                INDEX (requested_at)
             )
         """))
         db.commit()
@@ -76,6 +87,52 @@ def run_migrations(db):
     except Exception as e:
         db.rollback()
         print("Note: usage_log creation:", e)
+    # Per-request outcome columns (NULL for rows recorded without them)
+    for col, spec in [
+        ("injected_ms", "INT NULL"),
+        ("upstream_ms", "INT NULL"),
+        ("status_code", "SMALLINT NULL"),
+        ("failed", "TINYINT(1) NOT NULL DEFAULT 0"),
+    ]:
+        try:
+            db.execute(text(f"ALTER TABLE usage_log ADD COLUMN {col} {spec}"))
+            db.commit()
+            print(f"Added column {col} to usage_log")
+        except Exception:
+            db.rollback()
+    for table in ("usage_hourly", "usage_daily"):
+        for col in ("failures", "errors"):
+            try:
+                db.execute(text(f"ALTER TABLE {table} ADD COLUMN {col} BIGINT NOT NULL DEFAULT 0"))
+                db.commit()
+                print(f"Added column {col} to {table}")
+            except Exception:
+                db.rollback()
+    # Composite index for per-key time-range reads of usage_log
+    try:
+        db.execute(text("CREATE INDEX ix_usage_log_key_requested_at ON usage_log (config_api_key_id, requested_at)"))
+        db.commit()
+        print("Added index ix_usage_log_key_requested_at to usage_log")
+    except Exception:
+        db.rollback()
+    # Per-key and owner counters are seeded from usage_daily by the next rollup run (usage_rollup.refresh_rollups)
+    for col in ("counters_backfilled", "owner_months_backfilled"):
+        try:
+            db.execute(text(f"ALTER TABLE usage_rollup_state ADD COLUMN {col} TINYINT(1) NOT NULL DEFAULT 0"))
+            db.commit()
+            print(f"Added column {col} to usage_rollup_state")
+        except Exception:
+            db.rollback()
+    # usage_log retention; the one-time partition rebuild is `make usage-log-partition`
+    try:
+        result = maintain_usage_log(db)
+        if not list_partitions(db):
+            print("Note: usage_log is not partitioned yet; run `make usage-log-partition` once")
+        if result["dropped"]:
+            print("Dropped expired usage_log partitions:", ", ".join(result["dropped"]))
+    except Exception as e:
+        db.rollback()
+        print("Note: usage_log partitioning:", e)
     # Contact requests (user -> admin)
     try:
         db.execute(text("""
@@ -0,0 +1,73 @@
+# Log-linear latency histograms (HDR-style) stored as sparse (bin, count) rows.
+#
+# Values below 32 ms get one bin each; above that every power of two is split
+# into 16 equal sub-bins, so a bin's width is at most 1/16 of its value (about
+# 6% relative error) and 0 ms .. 24 h fits in under 400 bins. Histograms of
+# the same key are merged by adding counts per bin, which is what the rollup
+# tables do with ON DUPLICATE KEY UPDATE.
+import math
+from typing import Dict, Iterable, Optional
+
+SUB_BUCKETS = 16
+# Values below this map to their own bin (2 * SUB_BUCKETS)
+LINEAR_LIMIT = 2 * SUB_BUCKETS
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+
+def bin_index(value: int) -> int:
+    """Bin holding value (ms, clamped to >= 0)."""
+    value = max(0, int(value))
+    if value < LINEAR_LIMIT:
+        return value
+    shift = value.bit_length() - 5
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bin_range(index: int) -> tuple:
+    """(lowest, highest) value that maps to bin index."""
+    if index < LINEAR_LIMIT:
+        return index, index
+    shift = index // SUB_BUCKETS - 1
+    low = (index - shift * SUB_BUCKETS) << shift
+    return low, low + (1 << shift) - 1
+
+
+def bin_sql(column: str) -> str:
+    """MySQL expression computing bin_index(column); LENGTH(BIN(v)) is v's bit length."""
+    return (
+        f"CASE WHEN {column} < {LINEAR_LIMIT} THEN GREATEST({column}, 0) "
+        f"ELSE (LENGTH(BIN({column})) - 5) * {SUB_BUCKETS} + ({column} >> (LENGTH(BIN({column})) - 5)) END"
+    )
+
+
+def merge(histograms: Iterable[Dict[int, int]]) -> Dict[int, int]:
+    merged: Dict[int, int] = {}
+    for histogram in histograms:
+        for index, count in histogram.items():
+            merged[index] = merged.get(index, 0) + count
+    return merged
+
+
+def percentile(histogram: Dict[int, int], q: float, total: Optional[int] = None) -> Optional[int]:
+    """Value at quantile q, reported as the highest value of its bin (like HdrHistogram)."""
+    if total is None:
+        total = sum(histogram.values())
+    if total <= 0:
+        return None
+    rank = max(1, math.ceil(q * total))
+    seen = 0
+    for index in sorted(histogram):
+        seen += histogram[index]
+        if seen >= rank:
+            return bin_range(index)[1]
+    return bin_range(max(histogram))[1]
+
+
+def summarize(histogram: Dict[int, int]) -> dict:
+    """{"count", "p50", "p90", "p99", "p999", "max"} in ms (None when empty)."""
+    total = sum(histogram.values())
+    summary = {"count": total}
+    for name, q in PERCENTILES:
+        summary[name] = percentile(histogram, q, total)
+    summary["max"] = bin_range(max(histogram))[1] if total else None
+    return summary
@@ -1,23 +1,33 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import OperationalError, IntegrityError
 from pydantic import BaseModel, Field, field_validator, model_validator
 from typing import Optional, List
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
 from jose.exceptions import ExpiredSignatureError
-from passlib.context import CryptContext
+import asyncio
+import json
+import math
 import os
 import re
 import secrets
 import logging
+from contextlib import asynccontextmanager
 from urllib.parse import quote
 
 import stripe
+from anyio import to_thread
 
 logger = logging.getLogger(__name__)
+from auth_cache import UserSnapshot, user_cache
+from billing_mirror import billing_events, customer_invoices, failed_events, process_events, store_event, sync_user_plan
+from passwords import PasswordPoolBusy, password_pool
+from swr_cache import StaleWhileRevalidate
 from database import get_db, User as DBUser, ConfigApiKey as DBConfigApiKey, UsageLog as DBUsageLog, ContactRequest as DBContactRequest
 from email_sender import send_verification_email
 from billing import (
@@ -27,6 +37,12 @@ from billing import (
     get_keys_limit,
     get_requests_limit,
 )
+from latency_histogram import summarize
+from timeline import MAX_MINUTE_RANGE, MAX_TIMELINE_RANGE, TIMELINE_UNITS, TZ_OFFSET_RANGE, build_timeline
+from usage_rollup import LATENCY_METRICS, key_usage, latency_histograms, rollup_loop
+from usage_export import EXPORT_FORMATS, EXPORTERS
+from usage_live import live_usage
+from usage_retention import retention_loop
 
 # Security
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
@@ -36,11 +52,19 @@ if os.getenv("ENVIRONMENT") == "production" and SECRET_KEY == "your-secret-key-h
     raise RuntimeError("Set SECRET_KEY in production")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000").rstrip("/")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
 # Allowed HTTP methods for config
 ALLOWED_METHODS = frozenset({"ANY", "GET", "POST", "PUT", "DELETE", "PATCH"})
+# Latency distributions understood by the proxy
+LATENCY_DISTRIBUTIONS = ("uniform", "normal", "lognormal", "pareto", "bimodal", "empirical")
+# Numeric parameters per distribution and their minimum (None = any finite value)
+LATENCY_PARAM_MINIMUMS = {
+    "normal": {"mean": None, "std": 0},
+    "lognormal": {"median": 0, "sigma": 0},
+    "pareto": {"scale": 0, "alpha": 0.01},
+    "bimodal": {"low": None, "high": None, "std": 0, "p_high": 0},
+}
 
 async def security_headers_middleware(request: Request, call_next):
     """Add security headers to all responses."""
@@ -52,7 +76,43 @@ async def security_headers_middleware(request: Request, call_next):
     response.headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
     return response
 
-app = FastAPI()
+# Worker threads for the (sync) request handlers; keep at or below the DB pool size
+# (database.py) so a thread never waits on a connection while holding a slot
+API_THREADPOOL_SIZE = int(os.getenv("API_THREADPOOL_SIZE", "20"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Handlers and dependencies that touch the database are plain def: they run
+    # in this bounded threadpool and never block the event loop
+    to_thread.current_default_thread_limiter().total_tokens = API_THREADPOOL_SIZE
+    # Public plan catalogue, loaded in the background and kept in memory
+    plan_catalog.warm()
+    # Keep usage_hourly / usage_daily folded up from usage_log for the dashboard
+    rollups = asyncio.create_task(rollup_loop())
+    # Add upcoming usage_log partitions and drop expired, rolled-up ones
+    retention = asyncio.create_task(retention_loop())
+    # Apply queued Stripe webhook events to the billing mirror
+    billing = asyncio.create_task(billing_events.run())
+    try:
+        yield
+    finally:
+        rollups.cancel()
+        retention.cancel()
+        billing.cancel()
+        await live_usage.close()
+        password_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(PasswordPoolBusy)
+async def password_pool_busy_handler(request: Request, exc: PasswordPoolBusy):
+    """Login storm: shed password work instead of tying up the whole threadpool."""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many login attempts in progress. Please retry in a moment."},
+        headers={"Retry-After": "1"},
+    )
 
 app.middleware("http")(security_headers_middleware)
 app.add_middleware(
@@ -191,6 +251,35 @@ def _validate_http_https(url: Optional[str]) -> Optional[str]:
         raise ValueError("target_url too long")
     return u
 
+def _is_finite_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)
+
+def _validate_latency_params(kind: str, params: Optional[dict]) -> None:
+    """The proxy's LatencyDistribution checks (app/core/distributions.py), so a stored key always builds a sampler."""
+    if params is not None and not isinstance(params, dict):
+        raise ValueError("latency_params must be an object")
+    params = params or {}
+    for name, minimum in LATENCY_PARAM_MINIMUMS.get(kind, {}).items():
+        if name not in params:
+            continue
+        v = params[name]
+        if not _is_finite_number(v):
+            raise ValueError(f"latency_params.{name} must be a finite number")
+        if minimum is not None and v < minimum:
+            raise ValueError(f"latency_params.{name} must be >= {minimum}")
+    if kind == "bimodal" and params.get("p_high", 0) > 1:
+        raise ValueError("latency_params.p_high must be between 0 and 1")
+    if kind == "empirical":
+        bins, counts = params.get("bins"), params.get("counts")
+        if not isinstance(bins, list) or not isinstance(counts, list) or len(bins) != len(counts) + 1 or not counts:
+            raise ValueError("empirical needs latency_params.bins (k+1 edges) and counts (k weights)")
+        if not all(_is_finite_number(v) for v in bins + counts):
+            raise ValueError("empirical bins and counts must be finite numbers")
+        if any(b > a for a, b in zip(bins[1:], bins)) or any(c < 0 for c in counts) or not 0 < sum(counts) < math.inf:
+            raise ValueError("empirical bins must be increasing and counts non-negative")
+        if not all(math.isfinite(b - a) for a, b in zip(bins, bins[1:])):
+            raise ValueError("empirical bins and counts must be finite numbers")
+
 class ConfigApiKeyBase(BaseModel):
     name: str = Field(..., min_length=1, max_length=255)
     target_url: Optional[str] = None
@@ -199,12 +288,25 @@ class ConfigApiKeyBase(BaseModel):
     max_latency: int = Field(0, ge=0, le=60000)
     method: str = "ANY"
     error_codes: List[int] = []
+    bandwidth_kbps: int = Field(0, ge=0, le=10000000)
+    bandwidth_jitter: int = Field(0, ge=0, le=100)
+    latency_distribution: str = "uniform"
+    latency_params: Optional[dict] = None
+    chaos_seed: Optional[int] = Field(None, ge=0, le=2**63 - 1)
 
     @field_validator("target_url")
     @classmethod
     def target_url_http_https(cls, v: Optional[str]) -> Optional[str]:
         return _validate_http_https(v)
 
+    @field_validator("latency_distribution", mode="before")
+    @classmethod
+    def latency_distribution_allowed(cls, v: Optional[str]) -> str:
+        d = (v or "uniform").lower()
+        if d not in LATENCY_DISTRIBUTIONS:
+            raise ValueError("latency_distribution must be one of: " + ", ".join(LATENCY_DISTRIBUTIONS))
+        return d
+
     @field_validator("method")
     @classmethod
     def method_allowed(cls, v: str) -> str:
@@ -213,16 +315,6 @@ class ConfigApiKeyBase(BaseModel):
             raise ValueError("method must be one of: ANY, GET, POST, PUT, DELETE, PATCH")
         return u
 
-    @field_validator("error_codes")
-    @classmethod
-    def error_codes_range(cls, v: List[int]) -> List[int]:
-        if not v:
-            return []
-        for c in v:
-            if not isinstance(c, int) or c < 100 or c > 599:
-                raise ValueError("error_codes must be HTTP status codes 100-599")
-        return sorted(set(v))
-
     @model_validator(mode="after")
     def latency_order(self):
         if self.min_latency > self.max_latency:
@@ -230,7 +322,17 @@ class ConfigApiKeyBase(BaseModel):
         return self
 
 class ConfigApiKeyCreate(ConfigApiKeyBase):
-    pass
+    # Only new values are range-checked: stored keys may predate the 400-599 rule
+    # (the proxies skip such codes) and must still be listed
+    @field_validator("error_codes")
+    @classmethod
+    def error_codes_range(cls, v: List[int]) -> List[int]:
+        if not v:
+            return []
+        for c in v:
+            if not isinstance(c, int) or c < 400 or c > 599:
+                raise ValueError("error_codes must be HTTP error status codes 400-599")
+        return sorted(set(v))
 
 class ConfigApiKeyUpdate(BaseModel):
     name: Optional[str] = Field(None, min_length=1, max_length=255)
@@ -241,6 +343,12 @@ class ConfigApiKeyUpdate(BaseModel):
     max_latency: Optional[int] = Field(None, ge=0, le=60000)
     method: Optional[str] = None
     error_codes: Optional[List[int]] = None
+    bandwidth_kbps: Optional[int] = Field(None, ge=0, le=10000000)
+    bandwidth_jitter: Optional[int] = Field(None, ge=0, le=100)
+    latency_distribution: Optional[str] = None
+    latency_params: Optional[dict] = None
+    chaos_seed: Optional[int] = Field(None, ge=0, le=2**63 - 1)
+    clear_chaos_seed: bool = False
 
     @field_validator("target_url")
     @classmethod
@@ -249,6 +357,16 @@ class ConfigApiKeyUpdate(BaseModel):
             return None
         return _validate_http_https(v)
 
+    @field_validator("latency_distribution")
+    @classmethod
+    def latency_distribution_allowed(cls, v: Optional[str]) -> Optional[str]:
+        if v is None:
+            return None
+        d = v.lower()
+        if d not in LATENCY_DISTRIBUTIONS:
+            raise ValueError("latency_distribution must be one of: " + ", ".join(LATENCY_DISTRIBUTIONS))
+        return d
+
     @field_validator("method")
     @classmethod
     def method_allowed(cls, v: Optional[str]) -> Optional[str]:
@@ -265,8 +383,8 @@ class ConfigApiKeyUpdate(BaseModel):
         if v is None or not v:
             return v
         for c in v:
-            if not isinstance(c, int) or c < 100 or c > 599:
-                raise ValueError("error_codes must be 100-599")
+            if not isinstance(c, int) or c < 400 or c > 599:
+                raise ValueError("error_codes must be 400-599")
         return sorted(set(v))
 
 class ConfigApiKeyResponse(ConfigApiKeyBase):
@@ -279,7 +397,7 @@ class ConfigApiKeyResponse(ConfigApiKeyBase):
         orm_mode = True
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_pool.verify(plain_password, hashed_password)
 
 def get_user(db: Session, username: str):
     return db.query(DBUser).filter(DBUser.username == username).first()
@@ -321,7 +439,11 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> UserSnapshot:
+    return user_from_token(token, db)
+
+def user_from_token(token: str, db: Session, scope: Optional[str] = None) -> UserSnapshot:
+    """User for a JWT; scope is None for session tokens, or the single endpoint a scoped token is for."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -330,7 +452,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         sub: str = payload.get("sub")
-        if sub is None:
+        if sub is None or payload.get("scope") != scope:
             raise credentials_exception
     except ExpiredSignatureError:
         raise HTTPException(
@@ -340,13 +462,37 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         )
     except JWTError:
         raise credentials_exception
+    # Snapshot cached per subject: no DB round trip while fresh (see auth_cache.py)
+    cached = user_cache.get(sub)
+    if cached is not None:
+        return cached
+    generation = user_cache.generation()
     # sub is email (new tokens) or username (legacy)
     user = get_user_by_email(db, sub)
     if user is None:
         user = get_user(db, username=sub)
     if user is None:
         raise credentials_exception
-    return user
+    return user_cache.put(sub, user, generation)
+
+def get_current_user_for_update(current_user: UserSnapshot = Depends(get_current_user), db: Session = Depends(get_db)):
+    """The current user as a session-bound row, for handlers that modify it.
+
+    Caching of this user is suspended for the request and its snapshots are
+    dropped afterwards, so no reader sees the row as it was before the change.
+    """
+    user_cache.pin(current_user.id)
+    try:
+        user = db.get(DBUser, current_user.id)
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not validate credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        yield user
+    finally:
+        user_cache.unpin(current_user.id)
 
 class LoginRequest(BaseModel):
     email: str = Field(..., min_length=1, max_length=255)
@@ -354,7 +500,7 @@ class LoginRequest(BaseModel):
 
 # Routes
 @app.post("/api/auth/login")
-async def login_for_access_token(body: LoginRequest, db: Session = Depends(get_db)):
+def login_for_access_token(body: LoginRequest, db: Session = Depends(get_db)):
     try:
         user = authenticate_user(db, body.email.strip(), body.password)
         if not user:
@@ -367,13 +513,13 @@ async def login_for_access_token(body: LoginRequest, db: Session = Depends(get_d
             )
         access_token = create_access_token(data={"sub": user.email}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
         return {"access_token": access_token, "token_type": "bearer"}
-    except HTTPException:
+    except (HTTPException, PasswordPoolBusy):
         raise
     except Exception:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password", headers={"WWW-Authenticate": "Bearer"})
 
 @app.post("/api/auth/register")
-async def register_user(body: UserCreate, db: Session = Depends(get_db)):
+def register_user(body: UserCreate, db: Session = Depends(get_db)):
     try:
         email = (body.email or "").strip().lower()
         if not email or "@" not in email:
@@ -387,9 +533,10 @@ async def register_user(body: UserCreate, db: Session = Depends(get_db)):
                 logger.info("Register 400: Email already registered for %s", email)
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
             # Unverified account: send a new verification link and update password so they can retry
-            existing.hashed_password = pwd_context.hash(body.password)
+            existing.hashed_password = password_pool.hash(body.password)
             existing.full_name = body.full_name or existing.full_name
             db.commit()
+            user_cache.invalidate(existing.id)
             db.refresh(existing)
             verification_link = None
             try:
@@ -407,7 +554,7 @@ async def register_user(body: UserCreate, db: Session = Depends(get_db)):
             username=email,
             email=email,
             full_name=body.full_name or None,
-            hashed_password=pwd_context.hash(body.password),
+            hashed_password=password_pool.hash(body.password),
             disabled=False,
             email_verified=False,
         )
@@ -426,7 +573,7 @@ async def register_user(body: UserCreate, db: Session = Depends(get_db)):
         if verification_link:
             out["verification_link"] = verification_link
         return out
-    except HTTPException:
+    except (HTTPException, PasswordPoolBusy):
         raise
     except OperationalError as e:
         logger.exception("Register DB error: %s", e)
@@ -446,7 +593,7 @@ async def register_user(body: UserCreate, db: Session = Depends(get_db)):
 
 
 @app.get("/api/auth/verify-email")
-async def verify_email(token: str, db: Session = Depends(get_db)):
+def verify_email(token: str, db: Session = Depends(get_db)):
     """Verify email from link (registration or change-email). No auth required."""
     user = get_user_by_verification_token(db, token)
     if not user:
@@ -459,6 +606,7 @@ async def verify_email(token: str, db: Session = Depends(get_db)):
         user.username = user.pending_email
         user.pending_email = None
     db.commit()
+    user_cache.invalidate(user.id)
     access_token = create_access_token(
         data={"sub": user.email},
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
@@ -476,7 +624,7 @@ class ResendVerificationRequest(BaseModel):
 
 
 @app.post("/api/auth/resend-verification")
-async def resend_verification(body: ResendVerificationRequest, db: Session = Depends(get_db)):
+def resend_verification(body: ResendVerificationRequest, db: Session = Depends(get_db)):
     """Resend verification email. Pass email (for unauthenticated) or use current user."""
     email = (body.email or "").strip().lower()
     if not email:
@@ -496,7 +644,7 @@ async def resend_verification(body: ResendVerificationRequest, db: Session = Dep
 
 ADMIN_USER_ID = 1
 
-async def get_current_admin(current_user: DBUser = Depends(get_current_user)):
+def get_current_admin(current_user: UserSnapshot = Depends(get_current_user)) -> UserSnapshot:
     """Require current user to be admin (user id 1)."""
     if current_user.id != ADMIN_USER_ID:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin only")
@@ -504,7 +652,7 @@ async def get_current_admin(current_user: DBUser = Depends(get_current_user)):
 
 
 @app.get("/api/users/me", response_model=UserMe)
-async def read_users_me(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def read_users_me(db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
     plan = get_effective_plan(current_user)
     has_sub = bool(getattr(current_user, "stripe_subscription_id", None))
     return UserMe(
@@ -530,7 +678,7 @@ async def read_users_me(db: Session = Depends(get_db), current_user: DBUser = De
 
 
 @app.post("/api/users/me/resend-verification")
-async def resend_verification_me(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def resend_verification_me(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user_for_update)):
     """Resend verification email for current user (to pending_email if set, else to email)."""
     email_to = getattr(current_user, "pending_email", None) or current_user.email
     if not email_to:
@@ -545,10 +693,10 @@ async def resend_verification_me(db: Session = Depends(get_db), current_user: DB
 
 
 @app.patch("/api/users/me", response_model=UserMe)
-async def update_users_me(
+def update_users_me(
     body: UserUpdate,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: DBUser = Depends(get_current_user_for_update),
 ):
     """Update current user profile (email, full_name) and/or password."""
     dev_verification_link: Optional[str] = None
@@ -572,7 +720,7 @@ async def update_users_me(
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Current password required to set a new password")
         if not verify_password(body.current_password, current_user.hashed_password):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Current password is incorrect")
-        current_user.hashed_password = pwd_context.hash(body.new_password)
+        current_user.hashed_password = password_pool.hash(body.new_password)
     # Invoicing address (required for invoices under French law)
     if body.billing_first_name is not None:
         current_user.billing_first_name = body.billing_first_name.strip() or None
@@ -647,10 +795,10 @@ class ContactRequestCreate(BaseModel):
 
 
 @app.post("/api/contact")
-async def create_contact_request(
+def create_contact_request(
     body: ContactRequestCreate,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
     """Submit a contact/support request to admin. All authenticated users."""
     req = DBContactRequest(
@@ -665,9 +813,9 @@ async def create_contact_request(
 
 
 @app.get("/api/contact-requests")
-async def list_my_contact_requests(
+def list_my_contact_requests(
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
     """List current user's contact requests (with admin reply and closed_at)."""
     requests = (
@@ -693,10 +841,10 @@ async def list_my_contact_requests(
 
 
 @app.patch("/api/contact-requests/{request_id}/close")
-async def close_my_contact_request(
+def close_my_contact_request(
     request_id: int,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
     """Close own contact request. User can only close their own."""
     req = db.query(DBContactRequest).filter(
@@ -718,11 +866,11 @@ class AdminContactRequestUpdate(BaseModel):
 
 
 @app.patch("/api/admin/contact-requests/{request_id}")
-async def admin_update_contact_request(
+def admin_update_contact_request(
     request_id: int,
     body: AdminContactRequestUpdate,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_admin),
+    current_user: UserSnapshot = Depends(get_current_admin),
 ):
     """Admin: reply to and/or close a contact request."""
     req = db.query(DBContactRequest).filter(DBContactRequest.id == request_id).first()
@@ -742,9 +890,9 @@ async def admin_update_contact_request(
 
 
 @app.get("/api/admin/users")
-async def admin_list_users(
+def admin_list_users(
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_admin),
+    current_user: UserSnapshot = Depends(get_current_admin),
 ):
     """List all accounts (admin only, user id 1)."""
     users = db.query(DBUser).order_by(DBUser.id).all()
@@ -765,9 +913,9 @@ async def admin_list_users(
 
 
 @app.get("/api/admin/contact-requests")
-async def admin_list_contact_requests(
+def admin_list_contact_requests(
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_admin),
+    current_user: UserSnapshot = Depends(get_current_admin),
 ):
     """List all contact requests (admin only)."""
     requests = (
@@ -798,14 +946,25 @@ async def root():
 
 
 @app.get("/api/health")
-async def health(db: Session = Depends(get_db)):
+def health(db: Session = Depends(get_db)):
     """Server status: API up and DB connectivity."""
     from sqlalchemy import text
     try:
         db.execute(text("SELECT 1"))
     except Exception:
         raise HTTPException(status_code=503, detail="Database unavailable")
-    return {"status": "ok", "service": "api"}
+    try:
+        # Stripe events given up on after BILLING_EVENT_MAX_ATTEMPTS: need a look (or billing_mirror.py --backfill)
+        billing_failed = failed_events(db)
+    except Exception:
+        db.rollback()
+        billing_failed = None
+    return {
+        "status": "ok",
+        "service": "api",
+        "password_pool": password_pool.stats(),
+        "billing_events_failed": billing_failed,
+    }
 
 
 # Config API Keys
@@ -813,7 +972,12 @@ def generate_config_api_key():
     return f"lp_{secrets.token_urlsafe(32)}"
 
 @app.post("/api/config-keys/", response_model=ConfigApiKeyResponse)
-async def create_config_key(data: ConfigApiKeyCreate, db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def create_config_key(data: ConfigApiKeyCreate, db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
+    # Checked here rather than in the model: a 422 would echo non-finite input that JSON cannot encode
+    try:
+        _validate_latency_params(data.latency_distribution, data.latency_params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     plan = get_effective_plan(current_user)
     key_count = db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id).count()
     if key_count >= get_keys_limit(plan):
@@ -825,7 +989,10 @@ async def create_config_key(data: ConfigApiKeyCreate, db: Session = Depends(get_
         name=data.name, key=generate_config_api_key(), is_active=True,
         target_url=(data.target_url or "").strip() or None,
         fail_rate=min(100, max(0, data.fail_rate)), min_latency=data.min_latency or 0, max_latency=data.max_latency or 0,
-        method=(data.method or "ANY").upper(), error_codes=data.error_codes or [], owner_id=current_user.id
+        method=(data.method or "ANY").upper(), error_codes=data.error_codes or [],
+        bandwidth_kbps=data.bandwidth_kbps or 0, bandwidth_jitter=data.bandwidth_jitter or 0,
+        latency_distribution=data.latency_distribution, latency_params=data.latency_params,
+        chaos_seed=data.chaos_seed, owner_id=current_user.id
     )
     db.add(db_key)
     db.commit()
@@ -833,18 +1000,18 @@ async def create_config_key(data: ConfigApiKeyCreate, db: Session = Depends(get_
     return db_key
 
 @app.get("/api/config-keys/", response_model=List[ConfigApiKeyResponse])
-async def list_config_keys(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def list_config_keys(db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
     return db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id).all()
 
 @app.get("/api/config-keys/{key_id}/", response_model=ConfigApiKeyResponse)
-async def get_config_key(key_id: int, db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def get_config_key(key_id: int, db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
     k = db.query(DBConfigApiKey).filter(DBConfigApiKey.id == key_id, DBConfigApiKey.owner_id == current_user.id).first()
     if k is None:
         raise HTTPException(status_code=404, detail="Config key not found")
     return k
 
 @app.put("/api/config-keys/{key_id}/", response_model=ConfigApiKeyResponse)
-async def update_config_key(key_id: int, data: ConfigApiKeyUpdate, db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def update_config_key(key_id: int, data: ConfigApiKeyUpdate, db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
     k = db.query(DBConfigApiKey).filter(DBConfigApiKey.id == key_id, DBConfigApiKey.owner_id == current_user.id).first()
     if k is None:
         raise HTTPException(status_code=404, detail="Config key not found")
@@ -864,14 +1031,31 @@ async def update_config_key(key_id: int, data: ConfigApiKeyUpdate, db: Session =
         k.method = data.method.upper()
     if data.error_codes is not None:
         k.error_codes = data.error_codes
+    if data.bandwidth_kbps is not None:
+        k.bandwidth_kbps = data.bandwidth_kbps
+    if data.bandwidth_jitter is not None:
+        k.bandwidth_jitter = data.bandwidth_jitter
+    if data.latency_distribution is not None:
+        k.latency_distribution = data.latency_distribution
+    if data.latency_params is not None:
+        k.latency_params = data.latency_params or None
+    if data.chaos_seed is not None:
+        k.chaos_seed = data.chaos_seed
+    elif data.clear_chaos_seed:
+        k.chaos_seed = None
     if k.min_latency > k.max_latency:
         raise HTTPException(status_code=400, detail="min_latency cannot be greater than max_latency")
+    if data.latency_distribution is not None or data.latency_params is not None:
+        try:
+            _validate_latency_params(k.latency_distribution or "uniform", k.latency_params)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     db.commit()
     db.refresh(k)
     return k
 
 @app.delete("/api/config-keys/{key_id}/")
-async def delete_config_key(key_id: int, db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def delete_config_key(key_id: int, db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
     k = db.query(DBConfigApiKey).filter(DBConfigApiKey.id == key_id, DBConfigApiKey.owner_id == current_user.id).first()
     if k is None:
         raise HTTPException(status_code=404, detail="Config key not found")
@@ -882,36 +1066,29 @@ async def delete_config_key(key_id: int, db: Session = Depends(get_db), current_
 
 # Usage summary (raw counts for debugging empty chart)
 @app.get("/api/usage/summary")
-async def usage_summary(
+def usage_summary(
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
-    from sqlalchemy import text
+    keys = db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id).order_by(DBConfigApiKey.id).all()
     try:
-        r = db.execute(
-            text("""
-                SELECT COUNT(*) FROM usage_log u
-                INNER JOIN config_api_keys c ON c.id = u.config_api_key_id AND c.owner_id = :owner_id
-            """),
-            {"owner_id": current_user.id},
-        ).fetchone()
-        total = int(r[0]) if r and r[0] is not None else 0
+        usage = key_usage(db, [k.id for k in keys])
     except Exception:
-        return {"total_requests": 0, "by_key": [], "error": "usage_log table may be missing. Run: make init-db"}
-
-    keys = db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id).order_by(DBConfigApiKey.id).all()
-    by_key = []
-    for k in keys:
-        try:
-            r = db.execute(
-                text("SELECT COUNT(*) FROM usage_log WHERE config_api_key_id = :kid"),
-                {"kid": k.id},
-            ).fetchone()
-            cnt = int(r[0]) if r and r[0] is not None else 0
-        except Exception:
-            cnt = 0
-        by_key.append({"key_id": k.id, "key_name": k.name or f"Key {k.id}", "count": cnt})
-    return {"total_requests": total, "by_key": by_key}
+        return {"total_requests": 0, "by_key": [], "error": "usage tables may be missing. Run: make init-db"}
+    by_key = [
+        {
+            "key_id": k.id,
+            "key_name": k.name or f"Key {k.id}",
+            "count": usage[k.id]["count"],
+            "this_month": usage[k.id]["this_month"],
+        }
+        for k in keys
+    ]
+    return {
+        "total_requests": sum(k["count"] for k in by_key),
+        "requests_this_month": sum(k["this_month"] for k in by_key),
+        "by_key": by_key,
+    }
 
 
 def _format_stripe_price(price_obj) -> str:
@@ -927,76 +1104,88 @@ def _format_stripe_price(price_obj) -> str:
     return f"{amount:.2f}{symbol}/{interval}"
 
 
-# Public plans (prices fetched from Stripe by price_id)
-@app.get("/api/billing/plans")
-async def billing_plans():
+# Public plans (prices fetched from Stripe by price_id), cached with stale-while-revalidate
+STRIPE_PLANS_TTL = float(os.getenv("STRIPE_PLANS_TTL", "300"))
+STRIPE_PLANS_MAX_STALE = float(os.getenv("STRIPE_PLANS_MAX_STALE", "86400"))
+
+
+async def _fetch_stripe_plans() -> list:
+    """Retrieve every configured plan price from Stripe concurrently.
+
+    A price that fails keeps its entry from the previous catalogue, so a
+    complete catalogue stays complete; without one (cold start) that plan is
+    left out and logged. Only when every price fails is the reload failed.
+    """
     if STRIPE_SECRET_KEY == "localhost" or not STRIPE_SECRET_KEY:
-        return {"plans": []}
+        return []
     plan_defs = [
-        ("starter", "Starter", 10, 50000, STRIPE_STARTER_PRICE_ID),
-        ("pro", "Pro", 50, 500000, STRIPE_PRO_PRICE_ID),
+        (plan_id, name, keys, requests_per_month, price_id)
+        for plan_id, name, keys, requests_per_month, price_id in (
+            ("starter", "Starter", 10, 50000, STRIPE_STARTER_PRICE_ID),
+            ("pro", "Pro", 50, 500000, STRIPE_PRO_PRICE_ID),
+        )
+        if price_id and price_id.startswith("price_")
     ]
-    plans = []
     client = stripe.StripeClient(STRIPE_SECRET_KEY)
-    for plan_id, name, keys, requests_per_month, price_id in plan_defs:
-        if not price_id or not price_id.startswith("price_"):
-            continue
-        try:
-            price_obj = client.prices.retrieve(price_id)
-            price_display = _format_stripe_price(price_obj)
-            plans.append({
-                "id": plan_id,
-                "name": name,
-                "keys": keys,
-                "requests_per_month": requests_per_month,
-                "price_display": price_display,
-                "price_id": price_id,
-            })
-        except Exception:
+    prices = await asyncio.gather(
+        *(asyncio.to_thread(client.prices.retrieve, price_id) for *_, price_id in plan_defs),
+        return_exceptions=True,
+    )
+    if plan_defs and all(isinstance(p, Exception) for p in prices):
+        # Stripe unreachable: keep serving the cached catalogue
+        raise prices[0]
+    previous = {p["id"]: p for p in plan_catalog.current() or []}
+    plans = []
+    for (plan_id, name, keys, requests_per_month, price_id), price_obj in zip(plan_defs, prices):
+        if isinstance(price_obj, Exception):
+            kept = previous.get(plan_id)
+            if kept is not None and kept["price_id"] == price_id:
+                logger.warning("Stripe price %s for plan %s failed to load, keeping the previous entry: %s", price_id, plan_id, price_obj)
+                plans.append(kept)
+            else:
+                logger.warning("Stripe price %s for plan %s failed to load, plan not listed: %s", price_id, plan_id, price_obj)
             continue
-    return {"plans": plans}
+        plans.append({
+            "id": plan_id,
+            "name": name,
+            "keys": keys,
+            "requests_per_month": requests_per_month,
+            "price_display": _format_stripe_price(price_obj),
+            "price_id": price_id,
+        })
+    return plans
+
+
+plan_catalog = StaleWhileRevalidate("Stripe plans", _fetch_stripe_plans, STRIPE_PLANS_TTL, STRIPE_PLANS_MAX_STALE)
+
 
+@app.get("/api/billing/plans")
+async def billing_plans():
+    return {"plans": await plan_catalog.get() or []}
 
-# Sync plan from Stripe (call after checkout success; updates DB from Stripe subscriptions)
+
+# Sync plan from the billing mirror (call after checkout success). Applies webhook
+# events still queued, then re-derives the plan locally; no Stripe call.
 @app.post("/api/billing/sync")
-async def billing_sync(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def billing_sync(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user_for_update)):
     if STRIPE_SECRET_KEY == "localhost" or not STRIPE_SECRET_KEY:
         return {"plan": get_effective_plan(current_user), "synced": False}
-    cid = getattr(current_user, "stripe_customer_id", None)
-    if not cid:
+    if not getattr(current_user, "stripe_customer_id", None):
         return {"plan": "free", "synced": True}
-    client = stripe.StripeClient(STRIPE_SECRET_KEY)
     try:
-        for status in ("active", "trialing"):
-            subs = client.subscriptions.list(params={"customer": cid, "status": status, "limit": 1})
-            if not subs.data:
-                continue
-            sub = subs.data[0]
-            price_id = ""
-            items_resp = client.subscription_items.list(params={"subscription": sub.id})
-            if items_resp.data:
-                price_obj = getattr(items_resp.data[0], "price", None)
-                price_id = getattr(price_obj, "id", None) or ""
-            plan = "pro" if price_id == STRIPE_PRO_PRICE_ID else "starter"
-            current_user.stripe_subscription_id = sub.id
-            current_user.plan = plan
+        process_events(db)
+        if sync_user_plan(db, current_user):
             db.commit()
             db.refresh(current_user)
-            return {"plan": plan, "synced": True}
-        current_user.stripe_subscription_id = None
-        current_user.plan = "free"
-        db.commit()
-        db.refresh(current_user)
-    except stripe.StripeError:
-        return {"plan": get_effective_plan(current_user), "synced": False}
     except Exception:
+        db.rollback()
         return {"plan": get_effective_plan(current_user), "synced": False}
     return {"plan": get_effective_plan(current_user), "synced": True}
 
 
 # Billing usage (keys + requests this month)
 @app.get("/api/billing/usage")
-async def billing_usage(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def billing_usage(db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
     plan = get_effective_plan(current_user)
     keys_used = db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id).count()
     keys_limit = get_keys_limit(plan)
@@ -1014,113 +1203,213 @@ async def billing_usage(db: Session = Depends(get_db), current_user: DBUser = De
 
 
 @app.get("/api/billing/invoices")
-async def billing_invoices(
+def billing_invoices(
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
-    """List Stripe invoices for the current user. Stripe creates these automatically for subscriptions."""
+    """List the current user's invoices from the billing mirror (kept current by Stripe webhooks)."""
     cid = getattr(current_user, "stripe_customer_id", None)
     if not cid or STRIPE_SECRET_KEY == "localhost" or not STRIPE_SECRET_KEY:
         return {"invoices": []}
-    try:
-        client = stripe.StripeClient(STRIPE_SECRET_KEY)
-        resp = client.invoices.list(params={"customer": cid, "limit": 50})
-        invoices = []
-        for inv in (resp.data or []):
-            amount = getattr(inv, "amount_paid", None) or getattr(inv, "amount_due", None) or 0
-            currency = (getattr(inv, "currency", None) or "eur").upper()
-            created = getattr(inv, "created", None)
-            if isinstance(created, (int, float)):
-                created = datetime.utcfromtimestamp(created).isoformat() + "Z"
-            invoices.append({
-                "id": getattr(inv, "id", None),
-                "number": getattr(inv, "number", None),
-                "status": getattr(inv, "status", None),
-                "amount_due": getattr(inv, "amount_due", 0),
-                "amount_paid": getattr(inv, "amount_paid", 0),
-                "currency": currency,
-                "created": created,
-                "hosted_invoice_url": getattr(inv, "hosted_invoice_url", None),
-                "invoice_pdf": getattr(inv, "invoice_pdf", None),
-            })
-        return {"invoices": invoices}
-    except stripe.StripeError:
-        return {"invoices": []}
-    except Exception:
-        return {"invoices": []}
+    return {"invoices": customer_invoices(db, cid)}
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Query datetimes may carry an offset; usage tables store naive UTC."""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# Usage timeline (aggregated by minute/hour/day/month over any range up to a year)
+TIMELINE_PERIOD_RE = re.compile(r"^(\d{1,4})([hd])$")
 
 
-# Usage timeline (aggregated by hour/day/month)
 @app.get("/api/usage/timeline")
-async def usage_timeline(
+def usage_timeline(
     group_by: str = "day",
     period: str = "30d",
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    tz_offset: int = 0,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
-    from sqlalchemy import text
-    if group_by not in ("hour", "day", "month"):
-        raise HTTPException(status_code=400, detail="group_by must be hour, day, or month")
-    if period not in ("7d", "30d"):
-        raise HTTPException(status_code=400, detail="period must be 7d or 30d")
-    days = 7 if period == "7d" else 30
-    if group_by == "hour" and period == "30d":
-        raise HTTPException(status_code=400, detail="hour grouping only allowed with period=7d")
-    date_from = datetime.utcnow() - timedelta(days=days)
-
-    # MySQL date format for grouping
-    fmt = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "month": "%Y-%m"}[group_by]
-    bucket_col = f"DATE_FORMAT(u.requested_at, '{fmt}')"
+    """period ("12h", "7d", "90d", ...) counts back from date_to (default now); date_from overrides it.
+
+    Dates are UTC; tz_offset (minutes east of UTC) shifts bucket boundaries and labels to local time.
+    """
+    if group_by not in TIMELINE_UNITS:
+        raise HTTPException(status_code=400, detail="group_by must be minute, hour, day, or month")
+    if not TZ_OFFSET_RANGE[0] <= tz_offset <= TZ_OFFSET_RANGE[1]:
+        raise HTTPException(status_code=400, detail="tz_offset must be between -720 and 840 minutes")
+    date_to = _naive_utc(date_to) or datetime.utcnow()
+    date_from = _naive_utc(date_from)
+    if date_from is None:
+        match = TIMELINE_PERIOD_RE.match(period)
+        if not match:
+            raise HTTPException(status_code=400, detail="period must look like 24h or 30d")
+        amount, unit = int(match.group(1)), match.group(2)
+        date_from = date_to - (timedelta(hours=amount) if unit == "h" else timedelta(days=amount))
+    if date_from >= date_to:
+        raise HTTPException(status_code=400, detail="date_from must be before date_to")
+    if date_to - date_from > MAX_TIMELINE_RANGE:
+        raise HTTPException(status_code=400, detail="range must be at most 366 days")
+    if group_by == "minute" and date_to - date_from > MAX_MINUTE_RANGE:
+        raise HTTPException(status_code=400, detail="minute grouping only allowed for ranges up to 2 days")
 
     keys = db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id).order_by(DBConfigApiKey.id).all()
-    key_ids = [k.id for k in keys]
-
-    # Build ordered list of bucket labels for the range
-    labels = []
-    if group_by == "hour":
-        cur = date_from
-        while cur <= datetime.utcnow():
-            labels.append(cur.strftime("%Y-%m-%d %H:00"))
-            cur += timedelta(hours=1)
-    elif group_by == "day":
-        cur = date_from.date()
-        end = datetime.utcnow().date()
-        while cur <= end:
-            labels.append(cur.strftime("%Y-%m-%d"))
-            cur += timedelta(days=1)
-    else:
-        cur = date_from.replace(day=1)
-        end = datetime.utcnow()
-        while cur <= end:
-            labels.append(cur.strftime("%Y-%m"))
-            if cur.month == 12:
-                cur = cur.replace(year=cur.year + 1, month=1)
-            else:
-                cur = cur.replace(month=cur.month + 1)
 
-    # Raw query: count per (config_api_key_id, bucket) for user's keys
-    # MySQL: GROUP BY bucket, config_api_key_id
+    # Counts per (config_api_key_id, bucket) for all of the user's keys in one grouped
+    # read of the rollups plus the raw usage_log tail, zero-filled into a keys x buckets array
+    labels, counts = build_timeline(db, [k.id for k in keys], group_by, date_from, date_to, tz_offset)
+    series = [
+        {"key_id": k.id, "key_name": k.name or f"Key {k.id}", "counts": row}
+        for k, row in zip(keys, counts.tolist())
+    ]
+
+    return {
+        "group_by": group_by,
+        "period": period,
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "tz_offset": tz_offset,
+        "labels": labels,
+        "series": series,
+    }
+
+
+# Latency percentiles per key (from mergeable histograms, no raw row scan)
+LATENCY_PERIODS = {"24h": timedelta(hours=24), "7d": timedelta(days=7), "30d": timedelta(days=30)}
+
+
+@app.get("/api/usage/latency")
+def usage_latency(
+    period: str = "24h",
+    group_by: str = "total",
+    key_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: UserSnapshot = Depends(get_current_user),
+):
+    if period not in LATENCY_PERIODS:
+        raise HTTPException(status_code=400, detail="period must be 24h, 7d, or 30d")
+    if group_by not in ("total", "hour", "day", "month"):
+        raise HTTPException(status_code=400, detail="group_by must be total, hour, day, or month")
+    if group_by == "hour" and period == "30d":
+        raise HTTPException(status_code=400, detail="hour grouping only allowed with period=24h or 7d")
+    date_from = datetime.utcnow() - LATENCY_PERIODS[period]
+
+    query = db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id)
+    if key_id is not None:
+        query = query.filter(DBConfigApiKey.id == key_id)
+    keys = query.order_by(DBConfigApiKey.id).all()
+    if key_id is not None and not keys:
+        raise HTTPException(status_code=404, detail="Config key not found")
+
+    histograms, outcomes = latency_histograms(db, [k.id for k in keys], group_by, date_from)
     series = []
     for k in keys:
-        counts_by_bucket = {lb: 0 for lb in labels}
-        if key_ids:
-            q = text(f"""
-                SELECT {bucket_col} AS bucket, u.config_api_key_id, COUNT(*) AS cnt
-                FROM usage_log u
-                INNER JOIN config_api_keys c ON c.id = u.config_api_key_id AND c.owner_id = :owner_id
-                WHERE u.config_api_key_id = :key_id AND u.requested_at >= :date_from
-                GROUP BY bucket, u.config_api_key_id
-            """)
-            rows = db.execute(q, {"owner_id": current_user.id, "key_id": k.id, "date_from": date_from}).fetchall()
-            for row in rows:
-                # Normalize bucket to string so it matches label keys (MySQL may return datetime/bytes)
-                bucket = (str(row[0]).strip() if row[0] is not None else None)
-                if bucket and bucket in counts_by_bucket:
-                    counts_by_bucket[bucket] = row[2]
-        counts = [counts_by_bucket[lb] for lb in labels]
-        series.append({"key_id": k.id, "key_name": k.name or f"Key {k.id}", "counts": counts})
-
-    return {"group_by": group_by, "period": period, "labels": labels, "series": series}
+        labels = sorted(lb for (kid, lb) in outcomes if kid == k.id)
+        buckets = []
+        for lb in labels:
+            bucket = {"label": lb, **outcomes[(k.id, lb)]}
+            for metric in LATENCY_METRICS:
+                bucket[f"{metric}_ms"] = summarize(histograms.get((k.id, lb, metric), {}))
+            buckets.append(bucket)
+        series.append({"key_id": k.id, "key_name": k.name or f"Key {k.id}", "buckets": buckets})
+
+    return {"group_by": group_by, "period": period, "series": series}
+
+
+# Live per-key usage deltas (server-sent events), shared by all open dashboards
+USAGE_LIVE_KEEPALIVE = 15.0
+# EventSource cannot send an Authorization header: the stream takes a short-lived
+# token in the query string that is valid for nothing else
+USAGE_LIVE_SCOPE = "usage_live"
+USAGE_LIVE_TOKEN_SECONDS = 60
+
+
+@app.post("/api/usage/live/token")
+def usage_live_token(current_user: UserSnapshot = Depends(get_current_user)):
+    token = create_access_token(
+        data={"sub": current_user.email, "scope": USAGE_LIVE_SCOPE},
+        expires_delta=timedelta(seconds=USAGE_LIVE_TOKEN_SECONDS),
+    )
+    return {"token": token, "expires_in": USAGE_LIVE_TOKEN_SECONDS}
+
+
+@app.get("/api/usage/live")
+async def usage_live(
+    request: Request,
+    token: str,
+    db: Session = Depends(get_db),
+):
+    """Event stream of {"ts", "deltas": {key_id: {"requests", "failures", "errors"}}} about once per second.
+
+    token comes from POST /api/usage/live/token; it is only checked when the stream opens.
+    """
+    current_user = await run_in_threadpool(user_from_token, token, db, USAGE_LIVE_SCOPE)
+
+    def owner_key_ids():
+        try:
+            return [k.id for k in db.query(DBConfigApiKey.id).filter(DBConfigApiKey.owner_id == current_user.id)]
+        finally:
+            # Don't hold a pooled connection for the lifetime of the stream
+            db.close()
+
+    key_ids = await run_in_threadpool(owner_key_ids)
+
+    async def events():
+        sub = live_usage.subscribe(key_ids)
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    update = await asyncio.wait_for(sub.get(), USAGE_LIVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: usage\ndata: {json.dumps(update)}\n\n"
+        finally:
+            live_usage.unsubscribe(sub)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Raw usage export, streamed (constant memory for any range)
+@app.get("/api/usage/export")
+def usage_export(
+    format: str = "csv",
+    key_id: Optional[int] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: UserSnapshot = Depends(get_current_user),
+):
+    if format not in EXPORTERS:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    date_to = _naive_utc(date_to) or datetime.utcnow()
+    date_from = _naive_utc(date_from) or date_to - timedelta(days=30)
+    if date_from >= date_to:
+        raise HTTPException(status_code=400, detail="date_from must be before date_to")
+
+    query = db.query(DBConfigApiKey).filter(DBConfigApiKey.owner_id == current_user.id)
+    if key_id is not None:
+        query = query.filter(DBConfigApiKey.id == key_id)
+    key_names = {k.id: k.name or f"Key {k.id}" for k in query.all()}
+    if key_id is not None and not key_names:
+        raise HTTPException(status_code=404, detail="Config key not found")
+
+    filename = f"usage-{date_from:%Y%m%d%H%M}-{date_to:%Y%m%d%H%M}.{format}"
+    return StreamingResponse(
+        EXPORTERS[format](key_names, date_from, date_to),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 # Stripe billing: trial (1 day), checkout, portal, webhook
@@ -1131,7 +1420,7 @@ STRIPE_PRO_PRICE_ID = os.getenv("STRIPE_PRO_PRICE_ID", "")
 
 
 @app.post("/api/billing/trial")
-async def start_trial(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def start_trial(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user_for_update)):
     plan = get_effective_plan(current_user)
     if plan != "free":
         raise HTTPException(status_code=400, detail="Trial only for free plan")
@@ -1164,10 +1453,10 @@ def _allowed_checkout_price_ids() -> tuple:
 
 
 @app.post("/api/billing/checkout")
-async def create_checkout(
+def create_checkout(
     body: CheckoutRequest,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: DBUser = Depends(get_current_user_for_update),
 ):
     if STRIPE_SECRET_KEY == "localhost" or not STRIPE_SECRET_KEY:
         raise HTTPException(status_code=503, detail="Stripe not configured; use donation in localhost mode")
@@ -1226,10 +1515,10 @@ class UpgradeRequest(BaseModel):
 
 
 @app.post("/api/billing/upgrade")
-async def upgrade_subscription(
+def upgrade_subscription(
     body: UpgradeRequest,
     db: Session = Depends(get_db),
-    current_user: DBUser = Depends(get_current_user),
+    current_user: DBUser = Depends(get_current_user_for_update),
 ):
     """Upgrade from Starter to Pro: update Stripe subscription to Pro price, then update DB."""
     if STRIPE_SECRET_KEY == "localhost" or not STRIPE_SECRET_KEY:
@@ -1267,7 +1556,7 @@ async def upgrade_subscription(
 
 
 @app.post("/api/billing/portal")
-async def create_portal(db: Session = Depends(get_db), current_user: DBUser = Depends(get_current_user)):
+def create_portal(db: Session = Depends(get_db), current_user: UserSnapshot = Depends(get_current_user)):
     if STRIPE_SECRET_KEY == "localhost" or not STRIPE_SECRET_KEY:
         raise HTTPException(status_code=503, detail="Stripe not configured")
     cid = getattr(current_user, "stripe_customer_id", None)
@@ -1282,8 +1571,15 @@ async def create_portal(db: Session = Depends(get_db), current_user: DBUser = De
 
 @app.post("/api/billing/webhook")
 async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
+    """Verify and queue the event, then acknowledge; billing_events applies it in the background."""
     payload = await request.body()
     sig = request.headers.get("stripe-signature", "")
+    result = await run_in_threadpool(_handle_stripe_webhook, payload, sig, db)
+    billing_events.wake()
+    return result
+
+
+def _handle_stripe_webhook(payload: bytes, sig: str, db: Session):
     if not STRIPE_WEBHOOK_SECRET:
         raise HTTPException(status_code=503, detail="Webhook secret not set")
     client = stripe.StripeClient(STRIPE_SECRET_KEY)
@@ -1291,35 +1587,9 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
         event = client.construct_event(payload, sig, STRIPE_WEBHOOK_SECRET)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid webhook signature")
-    if event["type"] == "customer.subscription.created" or event["type"] == "customer.subscription.updated":
-        sub = event["data"]["object"]
-        sub_id = sub["id"]
-        customer_id = sub.get("customer")
-        status = sub.get("status", "")
-        if status in ("active", "trialing"):
-            items = sub.get("items") or {}
-            data = items.get("data") or []
-            price_id = ""
-            if data:
-                price_obj = data[0].get("price")
-                price_id = (price_obj.get("id") if isinstance(price_obj, dict) else price_obj) or ""
-            plan = "pro" if price_id == STRIPE_PRO_PRICE_ID else "starter"
-            user = db.query(DBUser).filter(DBUser.stripe_customer_id == customer_id).first()
-            if user:
-                user.stripe_subscription_id = sub_id
-                user.plan = plan
-                db.commit()
-        elif status == "paused":
-            user = db.query(DBUser).filter(DBUser.stripe_subscription_id == sub_id).first()
-            if user:
-                user.stripe_subscription_id = None
-                user.plan = "free"
-                db.commit()
-    elif event["type"] == "customer.subscription.deleted":
-        sub = event["data"]["object"]
-        user = db.query(DBUser).filter(DBUser.stripe_subscription_id == sub["id"]).first()
-        if user:
-            user.stripe_subscription_id = None
-            user.plan = "free"
-            db.commit()
+    if event["type"] in ("price.created", "price.updated", "price.deleted", "product.updated"):
+        # Plan catalogue changed: serve the cached one once more while it reloads
+        plan_catalog.invalidate()
+    # Stored once per event id (Stripe redelivers until it gets a 2xx)
+    store_event(db, payload)
     return {"received": True}
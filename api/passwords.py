@@ -0,0 +1,118 @@
+# Password hashing (bcrypt) in a bounded process pool.
+#
+# A bcrypt hash or verify costs 100+ ms of CPU. Running it in worker
+# processes keeps it off the API's threads, and the admission limit caps how
+# many request threads can wait on it: past PASSWORD_WORKERS running plus
+# PASSWORD_MAX_QUEUE queued, hash/verify raise PasswordPoolBusy (503) at
+# once. A login storm then slows logins only, while the other endpoints keep
+# their threadpool slots. A worker that dies breaks the whole executor; it is
+# replaced and the call retried once.
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from passlib.context import CryptContext
+
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(2, os.cpu_count() or 1))))
+PASSWORD_MAX_QUEUE = int(os.getenv("PASSWORD_MAX_QUEUE", "8"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, hashed: str) -> bool:
+    return pwd_context.verify(password, hashed)
+
+
+class PasswordPoolBusy(Exception):
+    """All workers busy and the queue full; the caller should answer 503."""
+
+
+class PasswordPoolBroken(PasswordPoolBusy):
+    """Workers kept dying: answered with 503 like a full pool, never as a wrong password."""
+
+
+class PasswordPool:
+    """Runs bcrypt in a ProcessPoolExecutor; hash() and verify() block the calling (threadpool) thread."""
+
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_queue: int = PASSWORD_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.completed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._in_flight = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise PasswordPoolBusy()
+            self._in_flight += 1
+        try:
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    result = executor.submit(fn, *args).result()
+                except BrokenProcessPool:
+                    self._discard(executor)
+                    if attempt:
+                        raise PasswordPoolBroken()
+                    continue
+                with self._lock:
+                    self.completed += 1
+                return result
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking the multi-threaded API process is unsafe
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor) -> None:
+        """Drop a broken executor; the next call starts a fresh one. Threads that hit the same break discard it once."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self.restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password: str) -> str:
+        return self._run(_hash, password)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        return self._run(_verify, password, hashed)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "queued": max(0, self._in_flight - self.workers),
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "restarts": self.restarts,
+            }
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,70 @@
+# In-memory stale-while-revalidate cache for one slowly changing value (e.g. the Stripe plan catalogue).
+#
+# Fresh values are returned as-is. A stale value (older than ttl but within
+# max_stale) is returned immediately while a single background task reloads
+# it; only a missing or expired value makes the caller wait for the load.
+# A failed load keeps serving the previous value, but never past ttl +
+# max_stale: from then on get() returns None until a load succeeds.
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StaleWhileRevalidate:
+    def __init__(self, name: str, loader: Callable[[], Awaitable[Any]], ttl: float, max_stale: float):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._value: Any = None
+        self._loaded_at: Optional[float] = None
+        # Bumped by invalidate(), possibly from a threadpool thread; the value is
+        # stale until a load that started after the last bump succeeds
+        self._invalidations = 0
+        self._loaded_invalidations = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self) -> Any:
+        age = None if self._loaded_at is None else time.monotonic() - self._loaded_at
+        if age is not None and age < self.ttl and self._invalidations == self._loaded_invalidations:
+            return self._value
+        refresh = self._refresh()
+        if age is not None and age < self.ttl + self.max_stale:
+            return self._value
+        # Nothing usable yet: wait for the load (shielded, other callers share it)
+        await asyncio.shield(refresh)
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl + self.max_stale:
+            return None
+        return self._value
+
+    def invalidate(self) -> None:
+        """Mark the value stale: it is still served while it reloads, until a reload succeeds."""
+        self._invalidations += 1
+
+    def current(self) -> Any:
+        """The last loaded value whatever its age (None before the first load), for loaders to fall back on."""
+        return self._value
+
+    def _refresh(self) -> asyncio.Task:
+        """Start the background load unless one is already running."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._load())
+        return self._task
+
+    async def _load(self) -> None:
+        invalidations = self._invalidations
+        try:
+            value = await self.loader()
+        except Exception as e:
+            logger.warning("%s refresh failed, keeping previous value: %s", self.name, e)
+            return
+        self._value = value
+        self._loaded_at = time.monotonic()
+        self._loaded_invalidations = invalidations
+
+    def warm(self) -> None:
+        """Start loading in the background at startup, so early requests are served from memory."""
+        self._refresh()
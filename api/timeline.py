@@ -0,0 +1,84 @@
+# Usage timeline: per-key request counts over a contiguous range of local-time buckets.
+#
+# Bucket labels and zero-filling are vectorized with NumPy datetime64 arrays:
+# rows from usage_buckets are mapped to (key, bucket) positions and summed
+# into a dense keys x buckets matrix with one np.bincount, so even a year of
+# hourly buckets across many keys is filled in milliseconds.
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from usage_rollup import usage_buckets
+
+# datetime64 unit of each bucket size, and the unit its label is printed with
+TIMELINE_UNITS = {"minute": "m", "hour": "h", "day": "D", "month": "M"}
+_LABEL_UNITS = {"minute": "m", "hour": "m", "day": "D", "month": "M"}
+
+MAX_TIMELINE_RANGE = timedelta(days=366)
+# Minute buckets are counted from raw usage_log rows, so their range is kept short
+MAX_MINUTE_RANGE = timedelta(days=2)
+# UTC offsets in minutes (UTC-12:00 .. UTC+14:00)
+TZ_OFFSET_RANGE = (-720, 840)
+
+
+def timeline_resolution(group_by: str, tz_offset: int) -> str:
+    """Resolution the counts are read at: minute (raw), hour or day (rollups).
+
+    UTC days only line up with local days at offset 0; otherwise day and
+    month buckets are summed from hourly rollups. Offsets that are not whole
+    hours attribute each UTC hour to the local bucket its start falls in.
+    """
+    if group_by == "minute":
+        return "minute"
+    if group_by == "hour" or tz_offset:
+        return "hour"
+    return "day"
+
+
+def build_timeline(
+    db: Session,
+    key_ids: List[int],
+    group_by: str,
+    date_from: datetime,
+    date_to: datetime,
+    tz_offset: int = 0,
+) -> Tuple[List[str], np.ndarray]:
+    """Labels and counts for every local bucket from date_from's to date_to's (UTC datetimes).
+
+    tz_offset is the local UTC offset in minutes; labels are local times
+    ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:00", "%Y-%m-%d" or "%Y-%m"). counts is
+    an int64 array of shape (len(key_ids), len(labels)), zero where a key
+    had no requests.
+    """
+    unit = TIMELINE_UNITS[group_by]
+    offset = np.timedelta64(tz_offset, "m")
+    first = (np.datetime64(date_from, "m") + offset).astype(f"datetime64[{unit}]")
+    last = (np.datetime64(date_to, "m") + offset).astype(f"datetime64[{unit}]")
+    buckets = np.arange(first, last + 1)
+    counts = np.zeros((len(key_ids), len(buckets)), dtype=np.int64)
+
+    # UTC range covering the whole local buckets, aligned to the read resolution
+    resolution = timeline_resolution(group_by, tz_offset)
+    start = (first.astype("datetime64[m]") - offset).astype(f"datetime64[{TIMELINE_UNITS[resolution]}]")
+    end = (last + 1).astype("datetime64[m]") - offset
+    rows = usage_buckets(
+        db, key_ids, resolution,
+        start.astype("datetime64[s]").item(), end.astype("datetime64[s]").item(),
+    )
+    if rows:
+        data = np.array(rows, dtype=np.int64)
+        keys = np.asarray(key_ids)
+        order = np.argsort(keys)
+        key_pos = order[np.searchsorted(keys, data[:, 0], sorter=order)]
+        local = (data[:, 1].astype("datetime64[m]") + offset).astype(f"datetime64[{unit}]")
+        pos = (local - first).astype(np.int64)
+        inside = (pos >= 0) & (pos < len(buckets))
+        flat = key_pos[inside] * len(buckets) + pos[inside]
+        counts = np.bincount(flat, weights=data[inside, 2], minlength=counts.size).astype(np.int64).reshape(counts.shape)
+
+    labels = np.datetime_as_string(buckets, unit=_LABEL_UNITS[group_by])
+    if group_by in ("minute", "hour"):
+        labels = np.char.replace(labels, "T", " ")
+    return labels.tolist(), counts
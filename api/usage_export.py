@@ -0,0 +1,68 @@
+# Usage export: raw usage_log rows streamed as CSV or NDJSON.
+#
+# Rows come from an unbuffered server-side cursor (stream_results) and are
+# encoded a partition at a time, so memory stays constant however many rows a
+# range holds. The generators are synchronous: StreamingResponse iterates them
+# in the threadpool, so a long export never blocks the event loop.
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+from sqlalchemy import DateTime, bindparam, text
+
+from database import engine
+
+# Rows fetched from the cursor and encoded per chunk of the response
+USAGE_EXPORT_CHUNK = int(os.getenv("USAGE_EXPORT_CHUNK", "5000"))
+
+EXPORT_FORMATS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+EXPORT_COLUMNS = ("id", "key_id", "key_name", "requested_at", "injected_ms", "upstream_ms", "status_code", "failed")
+
+# (config_api_key_id, requested_at) order follows ix_usage_log_key_requested_at, so no filesort
+_EXPORT_QUERY = text("""
+    SELECT id, config_api_key_id, requested_at, injected_ms, upstream_ms, status_code, failed
+    FROM usage_log
+    WHERE config_api_key_id IN :key_ids AND requested_at >= :date_from AND requested_at < :date_to
+    ORDER BY config_api_key_id, requested_at
+""").bindparams(bindparam("key_ids", expanding=True)).columns(requested_at=DateTime)
+
+
+def _rows(key_names: Dict[int, str], date_from: datetime, date_to: datetime) -> Iterator[List[tuple]]:
+    """Partitions of export rows in EXPORT_COLUMNS order."""
+    if not key_names:
+        return
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            _EXPORT_QUERY,
+            {"key_ids": list(key_names), "date_from": date_from, "date_to": date_to},
+        )
+        for partition in result.partitions(USAGE_EXPORT_CHUNK):
+            yield [
+                (row_id, key_id, key_names.get(key_id, ""), requested_at.isoformat(), injected, upstream, status, bool(failed))
+                for row_id, key_id, requested_at, injected, upstream, status, failed in partition
+            ]
+
+
+def export_csv(key_names: Dict[int, str], date_from: datetime, date_to: datetime) -> Iterator[bytes]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in _rows(key_names, date_from, date_to):
+        writer.writerows(rows)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        # Header only (no rows in range)
+        yield buf.getvalue().encode()
+
+
+def export_ndjson(key_names: Dict[int, str], date_from: datetime, date_to: datetime) -> Iterator[bytes]:
+    for rows in _rows(key_names, date_from, date_to):
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows).encode()
+
+
+EXPORTERS = {"csv": export_csv, "ndjson": export_ndjson}
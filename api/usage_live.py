@@ -0,0 +1,117 @@
+# Live usage feed for dashboards (server-sent events).
+#
+# One poller per API process reads the new usage_log rows once per interval
+# (a primary-key range, grouped by key) and fans the per-key deltas out to
+# every open dashboard stream. N open dashboards cost one small query per
+# second instead of N timeline aggregations; with no subscriber the poller
+# stops.
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import text
+
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+USAGE_LIVE_INTERVAL = float(os.getenv("USAGE_LIVE_INTERVAL", "1"))
+# Undelivered updates kept per stream; a slow client gets the oldest dropped
+USAGE_LIVE_QUEUE = 10
+
+
+class Subscription:
+    """One dashboard stream: the config keys it watches and its pending updates."""
+
+    def __init__(self, key_ids: List[int]):
+        self.key_ids: Set[int] = set(key_ids)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=USAGE_LIVE_QUEUE)
+
+    def offer(self, update: dict) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(update)
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+class LiveUsage:
+    """Polls usage_log deltas while at least one subscriber is connected.
+
+    Like the rollups, each poll only reads ids up to the MAX(id) seen by the
+    previous one, so inserts still in flight get an interval to commit; a
+    delta therefore trails recording by one or two intervals.
+    """
+
+    def __init__(self, interval: float = USAGE_LIVE_INTERVAL):
+        self.interval = interval
+        self._subscribers: Set[Subscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._last: Optional[int] = None
+        self._pending: Optional[int] = None
+
+    def subscribe(self, key_ids: List[int]) -> Subscription:
+        sub = Subscription(key_ids)
+        self._subscribers.add(sub)
+        if self._task is None or self._task.done():
+            self._last = self._pending = None
+            self._task = asyncio.create_task(self._run())
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        self._subscribers.discard(sub)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while self._subscribers:
+            try:
+                deltas = await asyncio.to_thread(self._poll)
+            except Exception as e:
+                logger.warning("Live usage poll failed: %s", e)
+                deltas = {}
+            if deltas:
+                ts = datetime.utcnow().isoformat()
+                for sub in list(self._subscribers):
+                    mine = {str(k): v for k, v in deltas.items() if k in sub.key_ids}
+                    if mine:
+                        sub.offer({"ts": ts, "deltas": mine})
+            await asyncio.sleep(self.interval)
+
+    def _poll(self) -> Dict[int, dict]:
+        """Per-key counts of usage_log rows in (last, pending]; then pending = MAX(id)."""
+        db = SessionLocal()
+        try:
+            deltas: Dict[int, dict] = {}
+            if self._last is not None and self._pending > self._last:
+                rows = db.execute(
+                    text("""
+                        SELECT config_api_key_id, COUNT(*), COALESCE(SUM(failed), 0), COALESCE(SUM(status_code >= 500), 0)
+                        FROM usage_log
+                        WHERE id > :lo AND id <= :hi
+                        GROUP BY config_api_key_id
+                    """),
+                    {"lo": self._last, "hi": self._pending},
+                ).fetchall()
+                deltas = {
+                    int(key_id): {"requests": int(cnt), "failures": int(failures), "errors": int(errors)}
+                    for key_id, cnt, failures, errors in rows
+                }
+                self._last = self._pending
+            max_id = int(db.execute(text("SELECT COALESCE(MAX(id), 0) FROM usage_log")).scalar() or 0)
+            if self._last is None:
+                # First poll: only rows recorded from now on are streamed
+                self._last = max_id
+            self._pending = max(max_id, self._last)
+            return deltas
+        finally:
+            db.close()
+
+
+live_usage = LiveUsage()
@@ -0,0 +1,174 @@
+# usage_log partitioning (one RANGE partition per UTC month) and retention.
+#
+# Old months are removed with DROP PARTITION instead of DELETE, which is
+# instant and leaves no fragmentation. A partition is dropped only when every
+# row in it is below the rollup watermark, i.e. already counted in the
+# usage_hourly / usage_daily rollups and counters.
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from usage_rollup import get_watermark
+
+logger = logging.getLogger(__name__)
+
+# Raw usage_log rows older than this are dropped (0 = keep forever)
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "90"))
+# Empty partitions kept ready for upcoming months
+USAGE_PARTITIONS_AHEAD = int(os.getenv("USAGE_PARTITIONS_AHEAD", "3"))
+USAGE_RETENTION_INTERVAL = float(os.getenv("USAGE_RETENTION_INTERVAL", "86400"))
+
+
+def _month(d: datetime) -> datetime:
+    return d.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(month: datetime, n: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + n
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def _partition(month: datetime) -> str:
+    """Partition holding rows of this month: pYYYYMM, VALUES LESS THAN the next month."""
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN ('{_add_months(month, 1):%Y-%m-%d}')"
+
+
+def list_partitions(db: Session) -> List[str]:
+    rows = db.execute(text("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'usage_log' AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)).fetchall()
+    return [r[0] for r in rows]
+
+
+def partition_usage_log(db: Session) -> bool:
+    """One-time conversion to a BIGINT id, PRIMARY KEY (id, requested_at) and monthly partitions.
+
+    MySQL requires the partitioning column in every unique key and does not
+    allow foreign keys on partitioned tables, so the FK to config_api_keys is
+    dropped (rows of deleted keys are ignored by the rollups and age out with
+    retention). This rebuilds the table once; returns False if already done.
+    """
+    if list_partitions(db):
+        return False
+    fks = db.execute(text("""
+        SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'usage_log' AND REFERENCED_TABLE_NAME IS NOT NULL
+    """)).fetchall()
+    for (name,) in fks:
+        db.execute(text(f"ALTER TABLE usage_log DROP FOREIGN KEY `{name}`"))
+    db.execute(text(
+        "ALTER TABLE usage_log MODIFY id BIGINT NOT NULL AUTO_INCREMENT, "
+        "DROP PRIMARY KEY, ADD PRIMARY KEY (id, requested_at)"
+    ))
+    first = db.execute(text("SELECT MIN(requested_at) FROM usage_log")).scalar()
+    now = _month(datetime.utcnow())
+    month = _month(first) if first else now
+    partitions = []
+    while month <= _add_months(now, USAGE_PARTITIONS_AHEAD):
+        partitions.append(_partition(month))
+        month = _add_months(month, 1)
+    partitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    db.execute(text(f"ALTER TABLE usage_log PARTITION BY RANGE COLUMNS(requested_at) ({', '.join(partitions)})"))
+    db.commit()
+    return True
+
+
+def ensure_partitions(db: Session, ahead: int = USAGE_PARTITIONS_AHEAD) -> List[str]:
+    """Split upcoming months out of pmax so new rows never land in the catch-all partition."""
+    names = [n for n in list_partitions(db) if n.startswith("p") and n[1:].isdigit()]
+    if not names:
+        return []
+    last = datetime.strptime(max(names)[1:], "%Y%m")
+    target = _add_months(_month(datetime.utcnow()), ahead)
+    added = []
+    month = _add_months(last, 1)
+    while month <= target:
+        db.execute(text(
+            f"ALTER TABLE usage_log REORGANIZE PARTITION pmax INTO "
+            f"({_partition(month)}, PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+        ))
+        added.append(f"p{month:%Y%m}")
+        month = _add_months(month, 1)
+    db.commit()
+    return added
+
+
+def drop_expired_partitions(db: Session, retention_days: int = USAGE_RETENTION_DAYS) -> List[str]:
+    """Drop monthly partitions that ended more than retention_days ago and are fully rolled up."""
+    if retention_days <= 0:
+        return []
+    cutoff = datetime.utcnow().timestamp() - retention_days * 86400
+    watermark = get_watermark(db)
+    dropped = []
+    for name in list_partitions(db):
+        if not (name.startswith("p") and name[1:].isdigit()):
+            continue
+        ends = _add_months(datetime.strptime(name[1:], "%Y%m"), 1)
+        if ends.timestamp() > cutoff:
+            break
+        max_id = db.execute(text(f"SELECT MAX(id) FROM usage_log PARTITION ({name})")).scalar()
+        if max_id is not None and max_id > watermark:
+            logger.warning("usage_log partition %s not fully rolled up yet; keeping it", name)
+            break
+        db.execute(text(f"ALTER TABLE usage_log DROP PARTITION {name}"))
+        dropped.append(name)
+    db.commit()
+    return dropped
+
+
+def maintain_usage_log(db: Session, convert: bool = False) -> dict:
+    """Partition maintenance and retention, run daily by the API.
+
+    The one-time table conversion (convert=True) only runs from
+    `python usage_retention.py --convert` (make usage-log-partition), so the
+    rebuild never starts from init_db.py or inside a serving process.
+    """
+    converted = partition_usage_log(db) if convert else False
+    if not converted and not list_partitions(db):
+        return {"partitioned": False, "added": [], "dropped": []}
+    return {
+        "partitioned": converted,
+        "added": ensure_partitions(db),
+        "dropped": drop_expired_partitions(db),
+    }
+
+
+def _maintain_once(convert: bool = False) -> dict:
+    db = SessionLocal()
+    try:
+        return maintain_usage_log(db, convert)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def retention_loop() -> None:
+    """Background job started by the API: keep future partitions ready and drop expired ones."""
+    while True:
+        try:
+            result = await asyncio.to_thread(_maintain_once)
+            if result["added"] or result["dropped"]:
+                logger.info("usage_log partitions added %s, dropped %s", result["added"], result["dropped"])
+        except Exception as e:
+            logger.warning("usage_log retention failed: %s", e)
+        await asyncio.sleep(USAGE_RETENTION_INTERVAL)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="usage_log partition maintenance and retention")
+    parser.add_argument("--convert", action="store_true", help="Rebuild usage_log into monthly partitions (one-time, locks the table)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(_maintain_once(convert=args.convert))
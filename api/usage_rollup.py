@@ -0,0 +1,457 @@
+# Usage rollups: hourly/daily request counts and latency histograms and
+# lifetime/monthly counters per config key, plus monthly counters per owner,
+# maintained incrementally from usage_log.
+#
+# usage_log ids up to a watermark are folded into usage_hourly, usage_daily,
+# usage_latency_hourly, usage_latency_daily, usage_key_counters,
+# usage_key_monthly and usage_owner_monthly in one transaction.
+# Reads combine the rollups with the raw rows above the watermark (at most a
+# couple of refresh intervals of traffic), so their cost does not grow with
+# the size of usage_log.
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from latency_histogram import bin_sql
+
+logger = logging.getLogger(__name__)
+
+USAGE_ROLLUP_INTERVAL = float(os.getenv("USAGE_ROLLUP_INTERVAL", "30"))
+# Max usage_log ids folded per run; a backlog is worked through in back-to-back runs
+USAGE_ROLLUP_BATCH = int(os.getenv("USAGE_ROLLUP_BATCH", "500000"))
+# How often owner quota counters are checked against raw usage_log rows (seconds)
+USAGE_RECONCILE_INTERVAL = float(os.getenv("USAGE_RECONCILE_INTERVAL", "3600"))
+ROLLUP_STATE = "usage_log"
+
+# Dashboard bucket label formats (MySQL DATE_FORMAT)
+BUCKET_FORMATS = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "month": "%Y-%m"}
+
+# Folds join config_api_keys: usage_log has no FK (it is partitioned), so rows
+# of deleted keys must be skipped rather than break the rollup FKs
+# usage_log bucket expression per rollup granularity
+_HOUR_BUCKET = "DATE_FORMAT(u.requested_at, '%Y-%m-%d %H:00:00')"
+_DAY_BUCKET = "DATE(u.requested_at)"
+# Injected failures and 5xx responses (injected or upstream) per group of usage_log rows
+_OUTCOME_COUNTS = "COALESCE(SUM(u.failed), 0) AS failed_cnt, COALESCE(SUM(u.status_code >= 500), 0) AS error_cnt"
+# Histogrammed usage_log columns, by metric name
+LATENCY_METRICS = {"injected": "injected_ms", "upstream": "upstream_ms"}
+
+
+def _fold_requests(table: str, bucket: str) -> str:
+    return f"""
+        INSERT INTO {table} (config_api_key_id, bucket, requests, failures, errors)
+        SELECT * FROM (
+            SELECT u.config_api_key_id, {bucket} AS bucket, COUNT(*) AS cnt, {_OUTCOME_COUNTS}
+            FROM usage_log u
+            INNER JOIN config_api_keys c ON c.id = u.config_api_key_id
+            WHERE u.id > :lo AND u.id <= :hi
+            GROUP BY u.config_api_key_id, bucket
+        ) AS s
+        ON DUPLICATE KEY UPDATE requests = requests + s.cnt, failures = failures + s.failed_cnt, errors = errors + s.error_cnt
+    """
+
+
+def _fold_latency(table: str, bucket: str) -> str:
+    """Add the batch's rows to the per-bin counts of each latency metric (rows with NULL are skipped)."""
+    selects = " UNION ALL ".join(
+        f"""
+            SELECT u.config_api_key_id, {bucket} AS bucket, '{metric}' AS metric, {bin_sql("u." + column)} AS bin, COUNT(*) AS cnt
+            FROM usage_log u
+            INNER JOIN config_api_keys c ON c.id = u.config_api_key_id
+            WHERE u.id > :lo AND u.id <= :hi AND u.{column} IS NOT NULL
+            GROUP BY u.config_api_key_id, bucket, bin
+        """
+        for metric, column in LATENCY_METRICS.items()
+    )
+    return f"""
+        INSERT INTO {table} (config_api_key_id, bucket, metric, bin, requests)
+        SELECT * FROM ({selects}) AS s
+        ON DUPLICATE KEY UPDATE requests = requests + s.cnt
+    """
+
+
+_FOLD_HOURLY = _fold_requests("usage_hourly", _HOUR_BUCKET)
+_FOLD_DAILY = _fold_requests("usage_daily", _DAY_BUCKET)
+_FOLD_LATENCY_HOURLY = _fold_latency("usage_latency_hourly", _HOUR_BUCKET)
+_FOLD_LATENCY_DAILY = _fold_latency("usage_latency_daily", _DAY_BUCKET)
+
+
+_FOLD_COUNTERS = """
+    INSERT INTO usage_key_counters (config_api_key_id, requests)
+    SELECT * FROM (
+        SELECT u.config_api_key_id, COUNT(*) AS cnt
+        FROM usage_log u
+        INNER JOIN config_api_keys c ON c.id = u.config_api_key_id
+        WHERE u.id > :lo AND u.id <= :hi
+        GROUP BY u.config_api_key_id
+    ) AS s
+    ON DUPLICATE KEY UPDATE requests = requests + s.cnt
+"""
+
+_FOLD_MONTHLY = """
+    INSERT INTO usage_key_monthly (config_api_key_id, month, requests)
+    SELECT * FROM (
+        SELECT u.config_api_key_id, DATE_FORMAT(u.requested_at, '%Y-%m-01') AS month, COUNT(*) AS cnt
+        FROM usage_log u
+        INNER JOIN config_api_keys c ON c.id = u.config_api_key_id
+        WHERE u.id > :lo AND u.id <= :hi
+        GROUP BY u.config_api_key_id, month
+    ) AS s
+    ON DUPLICATE KEY UPDATE requests = requests + s.cnt
+"""
+
+_FOLD_OWNER_MONTHLY = """
+    INSERT INTO usage_owner_monthly (owner_id, month, requests)
+    SELECT * FROM (
+        SELECT c.owner_id, DATE_FORMAT(u.requested_at, '%Y-%m-01') AS month, COUNT(*) AS cnt
+        FROM usage_log u
+        INNER JOIN config_api_keys c ON c.id = u.config_api_key_id
+        WHERE u.id > :lo AND u.id <= :hi
+        GROUP BY c.owner_id, month
+    ) AS s
+    ON DUPLICATE KEY UPDATE requests = requests + s.cnt
+"""
+
+# Counters set from usage_daily, which holds exactly the ids up to the watermark.
+# Rows folded since the counters existed are in usage_daily too, so setting
+# (rather than adding) is exact whenever this runs.
+_BACKFILL_COUNTERS = """
+    INSERT INTO usage_key_counters (config_api_key_id, requests)
+    SELECT * FROM (
+        SELECT config_api_key_id, SUM(requests) AS cnt FROM usage_daily GROUP BY config_api_key_id
+    ) AS s
+    ON DUPLICATE KEY UPDATE requests = s.cnt
+"""
+
+_BACKFILL_MONTHLY = """
+    INSERT INTO usage_key_monthly (config_api_key_id, month, requests)
+    SELECT * FROM (
+        SELECT config_api_key_id, DATE_FORMAT(bucket, '%Y-%m-01') AS month, SUM(requests) AS cnt
+        FROM usage_daily GROUP BY config_api_key_id, month
+    ) AS s
+    ON DUPLICATE KEY UPDATE requests = s.cnt
+"""
+
+# Owner counters keep the requests of deleted keys (whose usage_daily rows are
+# gone), so they are only ever raised
+_BACKFILL_OWNER_MONTHLY = """
+    INSERT INTO usage_owner_monthly (owner_id, month, requests)
+    SELECT * FROM (
+        SELECT c.owner_id, DATE_FORMAT(d.bucket, '%Y-%m-01') AS month, SUM(d.requests) AS cnt
+        FROM usage_daily d
+        INNER JOIN config_api_keys c ON c.id = d.config_api_key_id
+        GROUP BY c.owner_id, month
+    ) AS s
+    ON DUPLICATE KEY UPDATE requests = GREATEST(requests, s.cnt)
+"""
+
+_FOLDS = (
+    _FOLD_HOURLY, _FOLD_DAILY, _FOLD_LATENCY_HOURLY, _FOLD_LATENCY_DAILY,
+    _FOLD_COUNTERS, _FOLD_MONTHLY, _FOLD_OWNER_MONTHLY,
+)
+
+
+def refresh_rollups(db: Session) -> bool:
+    """Fold the next batch of usage_log rows into the rollups. Returns True if more are waiting.
+
+    Only ids up to the MAX(id) recorded by the previous run are folded: an
+    insert that was still in flight then has had a whole interval to commit,
+    so a lower id can no longer appear below the watermark. The state row is
+    locked, so concurrent API workers take turns.
+
+    The first run also seeds the per-key and owner counters from usage_daily
+    (see _BACKFILL_COUNTERS), under the same lock and before folding further.
+    """
+    params = {"name": ROLLUP_STATE}
+    lock = text("""
+        SELECT watermark, pending_max_id, counters_backfilled, owner_months_backfilled
+        FROM usage_rollup_state WHERE name = :name FOR UPDATE
+    """)
+    state = db.execute(lock, params).fetchone()
+    if state is None:
+        db.execute(text("""
+            INSERT IGNORE INTO usage_rollup_state (name, watermark, pending_max_id, counters_backfilled, owner_months_backfilled)
+            VALUES (:name, 0, 0, 0, 0)
+        """), params)
+        db.commit()
+        state = db.execute(lock, params).fetchone()
+    watermark, pending = int(state[0]), int(state[1])
+    if not state[2]:
+        db.execute(text(_BACKFILL_COUNTERS))
+        db.execute(text(_BACKFILL_MONTHLY))
+        db.execute(text("UPDATE usage_rollup_state SET counters_backfilled = 1 WHERE name = :name"), params)
+        logger.info("Usage rollup: seeded per-key counters from usage_daily up to id %d", watermark)
+    if not state[3]:
+        db.execute(text(_BACKFILL_OWNER_MONTHLY))
+        db.execute(text("UPDATE usage_rollup_state SET owner_months_backfilled = 1 WHERE name = :name"), params)
+        logger.info("Usage rollup: seeded owner month counters from usage_daily up to id %d", watermark)
+    target = min(pending, watermark + USAGE_ROLLUP_BATCH)
+    if target > watermark:
+        for fold in _FOLDS:
+            db.execute(text(fold), {"lo": watermark, "hi": target})
+    max_id = db.execute(text("SELECT COALESCE(MAX(id), 0) FROM usage_log")).scalar() or 0
+    db.execute(
+        text("UPDATE usage_rollup_state SET watermark = :w, pending_max_id = :p, updated_at = :now WHERE name = :name"),
+        {"w": max(watermark, target), "p": max(int(max_id), pending), "now": datetime.utcnow(), **params},
+    )
+    db.commit()
+    return target < pending
+
+
+def reconcile_owner_months(db: Session) -> int:
+    """Raise this month's owner counters to the raw usage_log count where they fell behind.
+
+    A counter can only undercount (a row committed below the watermark after
+    its batch was folded). Raw rows can also be missing: those of deleted
+    keys are skipped, and retention may already have dropped old partitions,
+    while the quota must still include them. So counters are never lowered.
+    The count up to the watermark is taken without holding the rollup lock;
+    folds only add rows above it, so raising to it can never overcount.
+    Returns the affected-row count (0 when every counter was already right).
+    """
+    month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    counts = db.execute(
+        text("""
+            SELECT c.owner_id, COUNT(*)
+            FROM usage_log u
+            INNER JOIN config_api_keys c ON c.id = u.config_api_key_id
+            WHERE u.requested_at >= :month AND u.id <= :watermark
+            GROUP BY c.owner_id
+        """),
+        {"month": month, "watermark": get_watermark(db)},
+    ).fetchall()
+    db.rollback()
+    if not counts:
+        return 0
+    result = db.execute(
+        text("""
+            INSERT INTO usage_owner_monthly (owner_id, month, requests) VALUES (:owner_id, :month, :cnt)
+            ON DUPLICATE KEY UPDATE requests = GREATEST(requests, VALUES(requests))
+        """),
+        [{"owner_id": owner_id, "month": month.date(), "cnt": int(cnt)} for owner_id, cnt in counts],
+    )
+    db.commit()
+    return result.rowcount
+
+
+def _run_once(job) -> object:
+    db = SessionLocal()
+    try:
+        return job(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _refresh_once() -> bool:
+    return _run_once(refresh_rollups)
+
+
+async def rollup_loop() -> None:
+    """Background refresher started by the API; runs refresh_rollups off the event loop."""
+    loop = asyncio.get_running_loop()
+    next_reconcile = loop.time() + USAGE_RECONCILE_INTERVAL
+    while True:
+        try:
+            more = await asyncio.to_thread(_refresh_once)
+        except Exception as e:
+            logger.warning("Usage rollup refresh failed: %s", e)
+            more = False
+        if loop.time() >= next_reconcile:
+            next_reconcile = loop.time() + USAGE_RECONCILE_INTERVAL
+            try:
+                corrected = await asyncio.to_thread(_run_once, reconcile_owner_months)
+                if corrected:
+                    logger.info("Usage reconcile: owner month counters updated (%d rows affected)", corrected)
+            except Exception as e:
+                logger.warning("Usage reconcile failed: %s", e)
+        if not more:
+            await asyncio.sleep(USAGE_ROLLUP_INTERVAL)
+
+
+def get_watermark(db: Session) -> int:
+    r = db.execute(text("SELECT watermark FROM usage_rollup_state WHERE name = :name"), {"name": ROLLUP_STATE}).fetchone()
+    return int(r[0]) if r else 0
+
+
+def owner_requests_this_month(db: Session, owner_id: int) -> int:
+    """Requests this UTC month across the owner's keys: counter row plus the raw tail."""
+    month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    r = db.execute(
+        text("""
+            SELECT
+                (SELECT COALESCE(SUM(requests), 0) FROM usage_owner_monthly WHERE owner_id = :oid AND month = :month),
+                (SELECT COUNT(*) FROM usage_log u
+                 INNER JOIN config_api_keys c ON c.id = u.config_api_key_id AND c.owner_id = :oid
+                 WHERE u.id > :watermark AND u.requested_at >= :month)
+        """),
+        {"oid": owner_id, "month": month, "watermark": get_watermark(db)},
+    ).fetchone()
+    return int(r[0] or 0) + int(r[1] or 0) if r else 0
+
+
+def _ids_query(sql: str):
+    return text(sql).bindparams(bindparam("key_ids", expanding=True))
+
+
+# Rollup table and bucket size in minutes per timeline resolution (None: raw rows only)
+BUCKET_SOURCES = {"minute": (None, 1), "hour": ("usage_hourly", 60), "day": ("usage_daily", 1440)}
+# Buckets are returned as minutes since 1970-01-01 (UTC, independent of the session time zone)
+_EPOCH_MINUTES = "TIMESTAMPDIFF(MINUTE, '1970-01-01', {})"
+
+
+def usage_buckets(db: Session, key_ids: List[int], resolution: str, start: datetime, end: datetime) -> List[Tuple[int, int, int]]:
+    """(config_api_key_id, bucket start in epoch minutes, requests) for buckets in [start, end).
+
+    resolution is "minute" (raw usage_log only), "hour" or "day"; start must
+    be aligned to it. Rollups cover ids up to the watermark and usage_log is
+    only read above it. Both reads run in the session's transaction, whose
+    consistent snapshot (InnoDB REPEATABLE READ) keeps a concurrent refresh
+    from being counted twice. A (key, bucket) may appear once per source.
+    """
+    if not key_ids:
+        return []
+    table, step = BUCKET_SOURCES[resolution]
+    watermark = get_watermark(db) if table else 0
+    bucket = f"{step} * ({_EPOCH_MINUTES.format('requested_at')} DIV {step})"
+    queries = [_ids_query(f"""
+        SELECT config_api_key_id, {bucket} AS bucket, COUNT(*)
+        FROM usage_log
+        WHERE config_api_key_id IN :key_ids AND id > :watermark AND requested_at >= :start AND requested_at < :end
+        GROUP BY config_api_key_id, bucket
+    """)]
+    if table:
+        queries.insert(0, _ids_query(f"""
+            SELECT config_api_key_id, {_EPOCH_MINUTES.format('bucket')}, requests
+            FROM {table}
+            WHERE config_api_key_id IN :key_ids AND bucket >= :start AND bucket < :end
+        """))
+    bind = {"key_ids": list(key_ids), "start": start, "end": end, "watermark": watermark}
+    rows: List[Tuple[int, int, int]] = []
+    for query in queries:
+        rows.extend(tuple(row) for row in db.execute(query, bind).fetchall())
+    return rows
+
+
+def key_usage(db: Session, key_ids: List[int]) -> Dict[int, Dict[str, int]]:
+    """Lifetime and current-month requests per config key: {key_id: {"count", "this_month"}}.
+
+    One primary-key read of the counters plus the raw tail above the watermark.
+    """
+    usage = {k: {"count": 0, "this_month": 0} for k in key_ids}
+    if not key_ids:
+        return usage
+    month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    counters = _ids_query("""
+        SELECT c.config_api_key_id, c.requests, COALESCE(m.requests, 0)
+        FROM usage_key_counters c
+        LEFT JOIN usage_key_monthly m ON m.config_api_key_id = c.config_api_key_id AND m.month = :month
+        WHERE c.config_api_key_id IN :key_ids
+    """)
+    tail = _ids_query("""
+        SELECT config_api_key_id, COUNT(*), SUM(requested_at >= :month)
+        FROM usage_log
+        WHERE config_api_key_id IN :key_ids AND id > :watermark
+        GROUP BY config_api_key_id
+    """)
+    bind = {"key_ids": list(key_ids), "month": month, "watermark": get_watermark(db)}
+    for query in (counters, tail):
+        for key_id, total, this_month in db.execute(query, bind).fetchall():
+            entry = usage[int(key_id)]
+            entry["count"] += int(total or 0)
+            entry["this_month"] += int(this_month or 0)
+    return usage
+
+
+def latency_histograms(db: Session, key_ids: List[int], group_by: str, date_from: datetime) -> Tuple[dict, dict]:
+    """Latency histograms and outcome counts per config key and bucket from date_from onwards.
+
+    group_by is "hour", "day", "month" or "total" (one bucket labelled
+    "total"; read from the hourly tables when date_from is within two days,
+    else from the daily ones). Returns ({(key_id, label, metric): {bin: count}},
+    {(key_id, label): {"requests", "failures", "errors"}}); like usage_buckets,
+    rollups up to the watermark are combined with the raw tail above it.
+    """
+    histograms: dict = defaultdict(lambda: defaultdict(int))
+    outcomes: dict = defaultdict(lambda: {"requests": 0, "failures": 0, "errors": 0})
+    if not key_ids:
+        return histograms, outcomes
+    hourly = group_by == "hour" or (group_by == "total" and datetime.utcnow() - date_from <= timedelta(days=2))
+    if hourly:
+        suffix, start = "hourly", date_from.replace(minute=0, second=0, microsecond=0)
+    else:
+        suffix, start = "daily", date_from.replace(hour=0, minute=0, second=0, microsecond=0)
+    if group_by == "month":
+        start = start.replace(day=1)
+    if group_by == "total":
+        label, raw_label = "'total'", "'total'"
+    else:
+        fmt = BUCKET_FORMATS[group_by]
+        label, raw_label = f"DATE_FORMAT(bucket, '{fmt}')", f"DATE_FORMAT(requested_at, '{fmt}')"
+    bind = {"key_ids": list(key_ids), "start": start, "watermark": get_watermark(db)}
+
+    raw_bins = " UNION ALL ".join(
+        f"""
+            SELECT config_api_key_id, {raw_label} AS label, '{metric}' AS metric, {bin_sql(column)} AS bin, COUNT(*)
+            FROM usage_log
+            WHERE config_api_key_id IN :key_ids AND id > :watermark AND requested_at >= :start AND {column} IS NOT NULL
+            GROUP BY config_api_key_id, label, bin
+        """
+        for metric, column in LATENCY_METRICS.items()
+    )
+    bins = (
+        _ids_query(f"""
+            SELECT config_api_key_id, {label} AS label, metric, bin, SUM(requests)
+            FROM usage_latency_{suffix}
+            WHERE config_api_key_id IN :key_ids AND bucket >= :start
+            GROUP BY config_api_key_id, label, metric, bin
+        """),
+        _ids_query(raw_bins),
+    )
+    for query in bins:
+        for key_id, lb, metric, index, cnt in db.execute(query, bind).fetchall():
+            lb = lb.decode() if isinstance(lb, bytes) else str(lb).strip()
+            histograms[(int(key_id), lb, str(metric))][int(index)] += int(cnt or 0)
+
+    counts = (
+        _ids_query(f"""
+            SELECT config_api_key_id, {label} AS label, SUM(requests), SUM(failures), SUM(errors)
+            FROM usage_{suffix}
+            WHERE config_api_key_id IN :key_ids AND bucket >= :start
+            GROUP BY config_api_key_id, label
+        """),
+        _ids_query(f"""
+            SELECT u.config_api_key_id, {raw_label} AS label, COUNT(*), {_OUTCOME_COUNTS}
+            FROM usage_log u
+            WHERE u.config_api_key_id IN :key_ids AND u.id > :watermark AND u.requested_at >= :start
+            GROUP BY u.config_api_key_id, label
+        """),
+    )
+    for query in counts:
+        for key_id, lb, requests, failures, errors in db.execute(query, bind).fetchall():
+            lb = lb.decode() if isinstance(lb, bytes) else str(lb).strip()
+            entry = outcomes[(int(key_id), lb)]
+            entry["requests"] += int(requests or 0)
+            entry["failures"] += int(failures or 0)
+            entry["errors"] += int(errors or 0)
+    return histograms, outcomes
+
+
+if __name__ == "__main__":
+    # One-off catch-up (e.g. after a large import). The first run only records
+    # MAX(id); the following ones fold up to it.
+    logging.basicConfig(level=logging.INFO)
+    _refresh_once()
+    while _refresh_once():
+        pass
+    print("Usage rollups up to date")
+    print("Owner month counters reconciled, rows affected:", _run_once(reconcile_owner_months))
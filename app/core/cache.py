@@ -0,0 +1,345 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Response cache configuration (override via environment)
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024)))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Distinct (method, URL) pairs whose Vary header names are remembered
+MAX_VARY_INDEX = 65536
+
+CACHEABLE_METHODS = frozenset({"GET", "HEAD"})
+# Status codes that are cacheable by default (RFC 9110 section 15.1)
+CACHEABLE_STATUS = frozenset({200, 203, 204, 206, 300, 301, 308, 404, 405, 410, 414, 501})
+# Request headers that make a response per-client: stored only if the upstream marks it shared
+# (public or s-maxage; RFC 9111 section 3.5)
+CREDENTIAL_HEADERS = ("authorization", "cookie")
+# Never stored, so one client's session is not replayed to another
+UNSTORED_HEADERS = frozenset({b"set-cookie", b"set-cookie2"})
+
+Headers = List[Tuple[bytes, bytes]]
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+def _header(headers: Headers, name: bytes) -> Optional[str]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+def storable_headers(headers: Headers) -> Headers:
+    return [(k, v) for k, v in headers if k.lower() not in UNSTORED_HEADERS]
+
+
+def freshness(headers: Headers, default_ttl: Optional[int] = None) -> Optional[float]:
+    """Seconds the response may be served from cache, or None if it must not be stored."""
+    cc = parse_cache_control(_header(headers, b"cache-control"))
+    if "no-store" in cc or "private" in cc or "no-cache" in cc:
+        return None
+    vary = _header(headers, b"vary")
+    if vary and vary.strip() == "*":
+        return None
+    for directive in ("s-maxage", "max-age"):
+        if directive in cc:
+            try:
+                return max(0, int(cc[directive]))
+            except (TypeError, ValueError):
+                return None
+    expires = _header(headers, b"expires")
+    if expires:
+        try:
+            date = _header(headers, b"date")
+            base = parsedate_to_datetime(date).timestamp() if date else time.time()
+            return max(0.0, parsedate_to_datetime(expires).timestamp() - base)
+        except (TypeError, ValueError):
+            return 0
+    return default_ttl
+
+
+class CachedResponse:
+    __slots__ = ("method", "url", "vary", "status", "headers", "body", "stored_at", "expires_at")
+
+    def __init__(self, method: str, url: str, vary: Tuple[str, ...], status: int, headers: Headers, body: bytes, stored_at: float, expires_at: float):
+        self.method = method
+        self.url = url
+        self.vary = vary
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+    def fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+    def to_bytes(self) -> bytes:
+        meta = {
+            "method": self.method,
+            "url": self.url,
+            "vary": list(self.vary),
+            "status": self.status,
+            "headers": [[k.decode("latin-1"), v.decode("latin-1")] for k, v in self.headers],
+            "stored_at": self.stored_at,
+            "expires_at": self.expires_at,
+        }
+        return json.dumps(meta).encode() + b"\n" + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CachedResponse":
+        meta, _, body = data.partition(b"\n")
+        m = json.loads(meta)
+        headers = storable_headers([(k.encode("latin-1"), v.encode("latin-1")) for k, v in m["headers"]])
+        return cls(m["method"], m["url"], tuple(m["vary"]), m["status"], headers, body, m["stored_at"], m["expires_at"])
+
+
+class DiskTier:
+    """Second cache tier for entries evicted from memory (one file per entry).
+
+    Its methods run in to_thread workers, possibly several at once: the file
+    index and byte count are guarded by a lock, file I/O happens outside it.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        # (method, url, vary) of entries found on disk, to rebuild the Vary index after a restart
+        self.found: List[Tuple[str, str, Tuple[str, ...]]] = []
+        os.makedirs(path, exist_ok=True)
+        entries = []
+        for name in os.listdir(path):
+            if name.startswith("."):
+                continue
+            full = os.path.join(path, name)
+            try:
+                st = os.stat(full)
+                with open(full, "rb") as f:
+                    meta = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            self.found.append((meta["method"], meta["url"], tuple(meta["vary"])))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.bytes += size
+
+    def _file(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def read(self, key: str) -> Optional[CachedResponse]:
+        name = self._file(key)
+        with self._lock:
+            if name not in self._files:
+                return None
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                return CachedResponse.from_bytes(f.read())
+        except (OSError, ValueError):
+            self.remove(key)
+            return None
+
+    def write(self, key: str, entry: CachedResponse) -> None:
+        name = self._file(key)
+        data = entry.to_bytes()
+        # Per-thread temp file: two workers may write the same key at once
+        tmp = os.path.join(self.path, f".{name}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.path, name))
+        evicted = []
+        with self._lock:
+            self.bytes += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            while self.bytes > self.max_bytes and self._files:
+                old, size = self._files.popitem(last=False)
+                self.bytes -= size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.path, old))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._files), "bytes": self.bytes}
+
+    def remove(self, key: str) -> None:
+        name = self._file(key)
+        with self._lock:
+            size = self._files.pop(name, None)
+            if size is not None:
+                self.bytes -= size
+        if size is not None:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class ResponseCache:
+    """Byte-bounded LRU of upstream responses keyed by method, URL and Vary'd request headers."""
+
+    def __init__(
+        self,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY_BYTES,
+        disk_path: str = RESPONSE_CACHE_DIR,
+        disk_max_bytes: int = RESPONSE_CACHE_DISK_MAX_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        # (method, url) -> header names listed in the upstream Vary
+        self._vary: "OrderedDict[Tuple[str, str], Tuple[str, ...]]" = OrderedDict()
+        self.disk = DiskTier(disk_path, disk_max_bytes) if disk_path else None
+        if self.disk is not None:
+            for method, url, vary in self.disk.found:
+                self._remember_vary(method, url, vary)
+            self.disk.found = []
+
+    def _remember_vary(self, method: str, url: str, vary: Tuple[str, ...]) -> None:
+        self._vary[(method, url)] = vary
+        self._vary.move_to_end((method, url))
+        if len(self._vary) > MAX_VARY_INDEX:
+            self._vary.popitem(last=False)
+
+    def _key(self, method: str, url: str, request_headers, vary: Tuple[str, ...]) -> str:
+        parts = [method, url]
+        for name in vary:
+            parts.append(f"{name}={request_headers.get(name, '')}")
+        return "\n".join(parts)
+
+    async def get(self, method: str, url: str, request_headers) -> Optional[CachedResponse]:
+        vary = self._vary.get((method, url))
+        if vary is None:
+            self.misses += 1
+            return None
+        key = self._key(method, url, request_headers, vary)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.fresh(now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._drop(key)
+        elif self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.read, key)
+            if entry is not None:
+                # Promoted to memory or expired: either way the file goes
+                await asyncio.to_thread(self.disk.remove, key)
+                if entry.fresh(now):
+                    self.disk_hits += 1
+                    await self._insert(key, entry)
+                    return entry
+        self.misses += 1
+        return None
+
+    def cacheable(self, method: str, status: int, headers: Headers, default_ttl: Optional[int] = None, request_headers=None) -> Optional[float]:
+        """TTL to store this response with, or None if it must not be cached.
+
+        The key only covers Vary'd headers, so a response to a request with
+        credentials is stored only when the upstream declares it shared.
+        """
+        if method not in CACHEABLE_METHODS or status not in CACHEABLE_STATUS:
+            return None
+        if request_headers is not None and any(request_headers.get(h) for h in CREDENTIAL_HEADERS):
+            cc = parse_cache_control(_header(headers, b"cache-control"))
+            if "public" not in cc and "s-maxage" not in cc:
+                return None
+        ttl = freshness(headers, default_ttl)
+        return ttl if ttl else None
+
+    async def put(self, method: str, url: str, request_headers, status: int, headers: Headers, body: bytes, ttl: float) -> None:
+        vary_header = _header(headers, b"vary") or ""
+        vary = tuple(sorted({v.strip().lower() for v in vary_header.split(",") if v.strip()}))
+        self._remember_vary(method, url, vary)
+        now = time.time()
+        entry = CachedResponse(method, url, vary, status, storable_headers(headers), body, now, now + ttl)
+        if entry.size > self.max_entry_bytes:
+            return
+        self.stores += 1
+        await self._insert(self._key(method, url, request_headers, vary), entry)
+
+    async def _insert(self, key: str, entry: CachedResponse) -> None:
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = entry
+        self.bytes += entry.size
+        spilled = []
+        while self.bytes > self.max_bytes and self._entries:
+            old_key, old = self._entries.popitem(last=False)
+            self.bytes -= old.size
+            self.evictions += 1
+            if self.disk is not None and old.fresh(time.time()):
+                spilled.append((old_key, old))
+        for old_key, old in spilled:
+            try:
+                await asyncio.to_thread(self.disk.write, old_key, old)
+            except OSError as e:
+                logger.warning("Response cache disk write failed: %s", e)
+
+    async def close(self) -> None:
+        """Persist fresh in-memory entries to the disk tier (if any) on shutdown."""
+        if self.disk is None:
+            return
+        now = time.time()
+        for key, entry in list(self._entries.items()):
+            if entry.fresh(now):
+                try:
+                    await asyncio.to_thread(self.disk.write, key, entry)
+                except OSError as e:
+                    logger.warning("Response cache disk write failed: %s", e)
+                    break
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
@@ -0,0 +1,51 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Only body-less idempotent requests are merged
+COALESCE_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+class SharedResponse(NamedTuple):
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+
+
+def coalesce_key(method: str, url: str, headers: List[Tuple[bytes, bytes]]) -> tuple:
+    """Requests merge only when method, URL and every forwarded header are identical."""
+    return (method, url, tuple(sorted((k.lower(), v) for k, v in headers)))
+
+
+class SingleFlight:
+    """Runs one upstream fetch per key at a time and shares its result with concurrent callers.
+
+    The fetch runs in its own task, so a caller that disconnects does not
+    cancel it for the others waiting on the same key.
+    """
+
+    def __init__(self):
+        self._calls: Dict[tuple, asyncio.Task] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: tuple, fetch: Callable[[], Awaitable[Optional[SharedResponse]]]) -> Tuple[Optional[SharedResponse], bool]:
+        """Return (response, shared); shared is True when another caller's fetch was reused."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.followers += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fetch())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key: tuple, task: asyncio.Task) -> None:
+        self._calls.pop(key, None)
+        # Mark the exception retrieved in case every caller went away before it finished
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
@@ -0,0 +1,30 @@
+import os
+from typing import Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+
+def database_url() -> str:
+    """DATABASE_URL, or a MySQL URL built from the DATABASE_* settings in .env."""
+    url = os.getenv("DATABASE_URL")
+    if url:
+        return url
+    return "mysql+pymysql://{user}:{password}@{host}:{port}/{name}".format(
+        user=os.getenv("DATABASE_USER", "latencypoison"),
+        password=os.getenv("DATABASE_PASSWORD", "latencypoison"),
+        host=os.getenv("DATABASE_HOST", "localhost"),
+        port=os.getenv("DATABASE_PORT", "3306"),
+        name=os.getenv("DATABASE_NAME", "latencypoison"),
+    )
+
+
+_engine: Optional[Engine] = None
+
+
+def get_engine() -> Engine:
+    """Process-wide engine, created on first use so the app starts without a database."""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(database_url(), pool_pre_ping=True, pool_recycle=3600)
+    return _engine
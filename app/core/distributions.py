@@ -0,0 +1,152 @@
+import json
+import math
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+DISTRIBUTIONS = ("uniform", "normal", "lognormal", "pareto", "bimodal", "empirical")
+
+# Samples drawn per refill; one NumPy call replaces SAMPLE_BATCH random.randint() calls
+SAMPLE_BATCH = 4096
+MAX_CACHED_SAMPLERS = 1024
+
+
+def _number(params: dict, name: str, default: float, minimum: Optional[float] = None) -> float:
+    value = params.get(name, default)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+        raise ValueError(f"{name} must be a finite number")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be >= {minimum}")
+    return float(value)
+
+
+class LatencyDistribution:
+    """Latency model in milliseconds, clamped to [min_latency, max_latency].
+
+    Parameters default to values derived from the range:
+      normal:    mean, std
+      lognormal: median, sigma
+      pareto:    scale (minimum value), alpha (tail index)
+      bimodal:   low, high, std, p_high (probability of the slow mode)
+      empirical: bins (k+1 edges in ms), counts (k weights)
+    """
+
+    def __init__(self, kind: str, min_latency: int, max_latency: int, params: Optional[dict] = None):
+        if kind not in DISTRIBUTIONS:
+            raise ValueError(f"distribution must be one of: {', '.join(DISTRIBUTIONS)}")
+        if params is None:
+            params = {}
+        if not isinstance(params, dict):
+            raise ValueError("distribution parameters must be an object")
+        self.kind = kind
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        spread = max_latency - min_latency
+        mid = min_latency + spread / 2
+        if kind == "normal":
+            self.mean = _number(params, "mean", mid)
+            self.std = _number(params, "std", spread / 6, 0)
+        elif kind == "lognormal":
+            self.median = _number(params, "median", max(mid, 1), 0)
+            self.sigma = _number(params, "sigma", 0.5, 0)
+        elif kind == "pareto":
+            self.scale = _number(params, "scale", max(min_latency, 1), 0)
+            self.alpha = _number(params, "alpha", 1.5, 0.01)
+        elif kind == "bimodal":
+            self.low = _number(params, "low", min_latency + spread * 0.2)
+            self.high = _number(params, "high", min_latency + spread * 0.8)
+            self.std = _number(params, "std", spread / 20, 0)
+            self.p_high = _number(params, "p_high", 0.1, 0)
+            if self.p_high > 1:
+                raise ValueError("p_high must be between 0 and 1")
+        elif kind == "empirical":
+            bins = params.get("bins")
+            counts = params.get("counts")
+            if not isinstance(bins, list) or not isinstance(counts, list) or len(bins) != len(counts) + 1 or not counts:
+                raise ValueError("empirical needs bins (k+1 edges) and counts (k weights)")
+            if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in bins + counts):
+                raise ValueError("empirical bins and counts must be numbers")
+            self.bins = np.asarray(bins, dtype=np.float64)
+            weights = np.asarray(counts, dtype=np.float64)
+            with np.errstate(over="ignore"):
+                finite = np.all(np.isfinite(np.diff(self.bins))) and np.isfinite(weights.sum())
+            if not finite or not np.all(np.isfinite(self.bins)) or not np.all(np.isfinite(weights)):
+                raise ValueError("empirical bins and counts must be finite")
+            if np.any(np.diff(self.bins) < 0) or np.any(weights < 0) or weights.sum() <= 0:
+                raise ValueError("empirical bins must be increasing and counts non-negative")
+            self.weights = weights / weights.sum()
+
+    def sample(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        """Draw n latencies (int64 ms) in one vectorised call."""
+        lo, hi = self.min_latency, self.max_latency
+        if self.kind == "uniform":
+            return rng.integers(lo, hi, size=n, endpoint=True)
+        if self.kind == "normal":
+            values = rng.normal(self.mean, self.std, size=n)
+        elif self.kind == "lognormal":
+            with np.errstate(over="ignore", invalid="ignore"):
+                values = self.median * np.exp(self.sigma * rng.standard_normal(n))
+        elif self.kind == "pareto":
+            values = self.scale * (1 + rng.pareto(self.alpha, size=n))
+        elif self.kind == "bimodal":
+            means = np.where(rng.random(n) < self.p_high, self.high, self.low)
+            values = rng.normal(means, self.std)
+        else:
+            index = rng.choice(len(self.weights), size=n, p=self.weights)
+            values = rng.uniform(self.bins[index], self.bins[index + 1])
+        # Extreme (but finite) parameters can still overflow to inf or 0 * inf
+        values = np.nan_to_num(values, nan=lo, posinf=hi, neginf=lo)
+        return np.clip(np.rint(values), lo, hi).astype(np.int64)
+
+
+class LatencySampler:
+    """Hands out latencies one at a time from a pre-generated buffer refilled in bulk."""
+
+    def __init__(self, distribution: LatencyDistribution, batch: int = SAMPLE_BATCH, rng: Optional[np.random.Generator] = None):
+        self.distribution = distribution
+        self.batch = batch
+        self.rng = rng or np.random.default_rng()
+        self._samples = iter(())
+
+    def next(self) -> int:
+        value = next(self._samples, None)
+        if value is None:
+            # Convert once per batch so the per-request path reads plain ints
+            self._samples = iter(self.distribution.sample(self.rng, self.batch).tolist())
+            value = next(self._samples)
+        return value
+
+
+_samplers: "OrderedDict[tuple, LatencySampler]" = OrderedDict()
+_samplers_lock = threading.Lock()
+
+
+def parse_params(raw: Optional[str]) -> dict:
+    """Decode a JSON object of distribution parameters (query-string form)."""
+    if not raw:
+        return {}
+    try:
+        params = json.loads(raw)
+    except ValueError:
+        raise ValueError("distribution_params must be a JSON object")
+    if not isinstance(params, dict):
+        raise ValueError("distribution_params must be a JSON object")
+    return params
+
+
+def get_sampler(kind: str, min_latency: int, max_latency: int, params: Optional[dict] = None) -> LatencySampler:
+    """Shared sampler for a distribution config; raises ValueError for invalid parameters."""
+    cache_key = (kind, min_latency, max_latency, json.dumps(params or {}, sort_keys=True))
+    with _samplers_lock:
+        sampler = _samplers.get(cache_key)
+        if sampler is not None:
+            _samplers.move_to_end(cache_key)
+            return sampler
+    sampler = LatencySampler(LatencyDistribution(kind, min_latency, max_latency, params))
+    with _samplers_lock:
+        _samplers[cache_key] = sampler
+        if len(_samplers) > MAX_CACHED_SAMPLERS:
+            _samplers.popitem(last=False)
+    return sampler
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import JSON, BigInteger, Boolean, Column, DateTime, Integer, MetaData, String, Table, Text, func, select
+from sqlalchemy.engine import Engine
+
+from .db import get_engine
+from .distributions import DISTRIBUTIONS, LatencySampler, get_sampler
+from .shaping import kbps_to_bytes
+from .tape import DecisionTape, get_tape
+
+logger = logging.getLogger(__name__)
+
+# Key snapshot refresh (override via environment)
+KEYSTORE_POLL_INTERVAL = float(os.getenv("KEYSTORE_POLL_INTERVAL", "2"))
+# Full reload even when the fingerprint is unchanged (catches edits made within the same second)
+KEYSTORE_FULL_RELOAD = float(os.getenv("KEYSTORE_FULL_RELOAD", "300"))
+
+# Error codes used when a key has none configured (same default as the Go proxy)
+DEFAULT_ERROR_CODES = [500, 503]
+
+# Columns the proxy needs; the table itself is owned by api/database.py
+config_api_keys = Table(
+    "config_api_keys",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("key", String(255)),
+    Column("is_active", Boolean),
+    Column("target_url", Text),
+    Column("fail_rate", Integer),
+    Column("min_latency", Integer),
+    Column("max_latency", Integer),
+    Column("method", String(20)),
+    Column("error_codes", JSON),
+    Column("latency_distribution", String(32)),
+    Column("latency_params", JSON),
+    Column("chaos_seed", BigInteger),
+    Column("bandwidth_kbps", Integer),
+    Column("bandwidth_jitter", Integer),
+    Column("owner_id", Integer),
+    Column("updated_at", DateTime),
+)
+
+
+class KeyConfig:
+    """A config key's settings, compiled once per snapshot for the request path."""
+
+    __slots__ = (
+        "id", "owner_id", "key", "target_url", "method", "fail_rate", "error_codes",
+        "sampler", "chaos_seed", "bandwidth", "bandwidth_jitter",
+    )
+
+    def __init__(self, row):
+        self.id = row.id
+        self.owner_id = row.owner_id
+        self.key = row.key
+        self.target_url = (row.target_url or "").strip().rstrip("/")
+        self.method = (row.method or "ANY").upper()
+        # Stored as a 0-100 percentage
+        self.fail_rate = (row.fail_rate or 0) / 100
+        self.error_codes: List[int] = [int(c) for c in (row.error_codes or []) if 400 <= int(c) <= 599] or DEFAULT_ERROR_CODES
+        self.chaos_seed: Optional[int] = row.chaos_seed
+        self.bandwidth = kbps_to_bytes(row.bandwidth_kbps) if row.bandwidth_kbps else 0
+        self.bandwidth_jitter = (row.bandwidth_jitter or 0) / 100
+        self.sampler: Optional[LatencySampler] = None
+        min_latency, max_latency = row.min_latency or 0, row.max_latency or 0
+        if max_latency > 0:
+            kind = row.latency_distribution if row.latency_distribution in DISTRIBUTIONS else "uniform"
+            params = row.latency_params if isinstance(row.latency_params, dict) else {}
+            try:
+                self.sampler = get_sampler(kind, min_latency, max_latency, params)
+            except ValueError as e:
+                logger.warning("Config key %s: invalid latency settings (%s), latency disabled", row.id, e)
+
+    @property
+    def valid_target(self) -> bool:
+        return self.target_url.lower().startswith(("http://", "https://"))
+
+    def tape(self) -> DecisionTape:
+        return get_tape(self.chaos_seed, self.sampler.distribution if self.sampler else None, self.fail_rate, self.error_codes)
+
+
+Fingerprint = Tuple[int, Optional[int], Optional[object]]
+
+
+class KeyStore:
+    """In-memory snapshot of active config keys, looked up by key without a database round trip.
+
+    A background task polls a cheap fingerprint (row count, max id, max
+    updated_at) and reloads the whole snapshot only when it changes, swapping
+    the dict in one assignment so lookups never see a half-built map.
+    """
+
+    def __init__(self, poll_interval: float = KEYSTORE_POLL_INTERVAL, full_reload: float = KEYSTORE_FULL_RELOAD):
+        self.poll_interval = poll_interval
+        self.full_reload = full_reload
+        self.reloads = 0
+        self.errors = 0
+        self.loaded_at = 0.0
+        self._keys: Dict[str, KeyConfig] = {}
+        self._fingerprint: Optional[Fingerprint] = None
+        self._task: Optional[asyncio.Task] = None
+        self._engine: Optional[Engine] = None
+
+    def get(self, key: str) -> Optional[KeyConfig]:
+        return self._keys.get(key)
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._task = asyncio.create_task(self._poll())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Reload the snapshot if the table changed (or when forced). Returns True if reloaded."""
+        try:
+            result = await asyncio.to_thread(self._load, force)
+        except Exception as e:
+            # Keep serving the last snapshot while the database is unavailable
+            self.errors += 1
+            logger.warning("Config key refresh failed: %s", e)
+            return False
+        if result is None:
+            return False
+        self._fingerprint, self._keys = result
+        self.reloads += 1
+        self.loaded_at = time.time()
+        return True
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.refresh(force=time.time() - self.loaded_at >= self.full_reload)
+
+    def _load(self, force: bool) -> Optional[Tuple[Fingerprint, Dict[str, KeyConfig]]]:
+        if self._engine is None:
+            self._engine = get_engine()
+        t = config_api_keys.c
+        with self._engine.connect() as conn:
+            fingerprint = tuple(conn.execute(select(func.count(), func.max(t.id), func.max(t.updated_at)).select_from(config_api_keys)).one())
+            if not force and fingerprint == self._fingerprint:
+                return None
+            rows = conn.execute(select(config_api_keys).where(t.is_active.is_(True))).all()
+        keys = {}
+        for row in rows:
+            if row.key:
+                keys[row.key] = KeyConfig(row)
+        return fingerprint, keys
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._keys),
+            "reloads": self.reloads,
+            "errors": self.errors,
+            "loaded_at": self.loaded_at or None,
+            "poll_interval": self.poll_interval,
+        }
@@ -0,0 +1,65 @@
+import asyncio
+import random
+import time
+from typing import AsyncIterator, Optional
+
+# Bytes are released at most every PACING_TICK seconds (one quantum per tick)
+PACING_TICK = 0.05
+MIN_QUANTUM = 512
+
+
+def kbps_to_bytes(kbps: float) -> float:
+    """kbit/s (1000 bits) to bytes per second."""
+    return kbps * 1000 / 8
+
+
+class TokenBucket:
+    """Byte token bucket refilled at `rate` bytes/s, with a +/- `jitter` fraction applied per refill."""
+
+    __slots__ = ("rate", "jitter", "burst", "tokens", "updated", "_random")
+
+    def __init__(self, rate: float, jitter: float = 0.0, burst: Optional[int] = None, rng: Optional[random.Random] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.jitter = jitter
+        self.burst = burst or max(int(rate * PACING_TICK), MIN_QUANTUM)
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self._random = (rng or random).random
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        rate = self.rate
+        if self.jitter:
+            rate *= 1 + self.jitter * (2 * self._random() - 1)
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    async def consume(self, wanted: int) -> int:
+        """Wait until at least one byte is available and grant up to `wanted` bytes."""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                granted = min(wanted, int(self.tokens))
+                self.tokens -= granted
+                return granted
+            # Sleep for one quantum (or what is left to send) instead of waking per byte
+            await asyncio.sleep((min(wanted, self.burst) - self.tokens) / self.rate)
+
+
+async def paced(chunks: AsyncIterator[bytes], bucket: TokenBucket) -> AsyncIterator[bytes]:
+    """Re-emit `chunks` at the bucket rate.
+
+    A chunk granted whole is passed on as-is; otherwise the pieces are sliced
+    out of a memoryview, so only the bytes sent per tick are copied (ASGI
+    servers require bytes bodies).
+    """
+    async for chunk in chunks:
+        view = memoryview(chunk)
+        size = len(view)
+        offset = 0
+        while offset < size:
+            granted = await bucket.consume(size - offset)
+            yield chunk if granted == size else bytes(view[offset:offset + granted])
+            offset += granted
@@ -0,0 +1,160 @@
+import hashlib
+import itertools
+import json
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+from .distributions import LatencyDistribution
+
+# Decisions are generated in fixed blocks so any index can be rebuilt from (seed, block) alone
+TAPE_BLOCK = 4096
+MAX_CACHED_BLOCKS = 8
+MAX_TAPES = 256
+
+
+class Decision(NamedTuple):
+    index: int
+    latency: int
+    failed: bool
+    error_code: int
+
+
+class DecisionTape:
+    """Deterministic per-request chaos decisions (latency, fail flag, error code) for a seed.
+
+    Request N of a run always gets decision N, so a load test replayed with the
+    same seed and chaos settings sees exactly the same latencies and failures.
+    """
+
+    def __init__(
+        self,
+        seed: int,
+        distribution: Optional[LatencyDistribution],
+        fail_rate: float,
+        error_codes: List[int],
+    ):
+        self.seed = seed
+        self.distribution = distribution
+        self.fail_rate = fail_rate
+        self.error_codes = np.asarray(error_codes or [500], dtype=np.int64)
+        self.id = tape_id(seed, distribution, fail_rate, error_codes)
+        self._cursor = itertools.count()
+        self._issued = 0
+        self._blocks: "OrderedDict[int, tuple]" = OrderedDict()
+
+    def config(self) -> dict:
+        d = self.distribution
+        return {
+            "seed": self.seed,
+            "distribution": d.kind if d else None,
+            "min_latency": d.min_latency if d else 0,
+            "max_latency": d.max_latency if d else 0,
+            "fail_rate": self.fail_rate,
+            "error_codes": self.error_codes.tolist(),
+        }
+
+    def _generate(self, block: int) -> tuple:
+        rng = np.random.default_rng([self.seed, block])
+        if self.distribution is not None:
+            latency = self.distribution.sample(rng, TAPE_BLOCK)
+        else:
+            latency = np.zeros(TAPE_BLOCK, dtype=np.int64)
+        failed = rng.random(TAPE_BLOCK) < self.fail_rate
+        codes = self.error_codes[rng.integers(0, len(self.error_codes), size=TAPE_BLOCK)]
+        codes = np.where(failed, codes, 0)
+        return latency.tolist(), failed.tolist(), codes.tolist()
+
+    def _block(self, block: int) -> tuple:
+        # No lock: blocks are pure functions of (seed, block), so a concurrent
+        # rebuild produces identical values and either copy may win.
+        data = self._blocks.get(block)
+        if data is None:
+            data = self._generate(block)
+            self._blocks[block] = data
+            while len(self._blocks) > MAX_CACHED_BLOCKS:
+                try:
+                    self._blocks.popitem(last=False)
+                except KeyError:
+                    break
+        return data
+
+    def at(self, index: int) -> Decision:
+        latency, failed, codes = self._block(index // TAPE_BLOCK)
+        i = index % TAPE_BLOCK
+        return Decision(index, latency[i], failed[i], codes[i])
+
+    def next(self) -> Decision:
+        """Decision for the next request of the run (itertools.count is atomic under the GIL)."""
+        index = next(self._cursor)
+        self._issued = index + 1
+        return self.at(index)
+
+    @property
+    def position(self) -> int:
+        """Number of decisions handed out since creation or the last rewind (informational)."""
+        return self._issued
+
+    def rewind(self) -> None:
+        self._cursor = itertools.count()
+        self._issued = 0
+
+    def export(self, start: int, count: int) -> dict:
+        """Columnar dump of decisions [start, start + count)."""
+        latency, failed, codes = [], [], []
+        index = start
+        end = start + count
+        while index < end:
+            block = index // TAPE_BLOCK
+            lat, fail, code = self._block(block)
+            lo = index - block * TAPE_BLOCK
+            hi = min(TAPE_BLOCK, end - block * TAPE_BLOCK)
+            latency.extend(lat[lo:hi])
+            failed.extend(fail[lo:hi])
+            codes.extend(code[lo:hi])
+            index = (block + 1) * TAPE_BLOCK
+        return {
+            "id": self.id,
+            "config": self.config(),
+            "start": start,
+            "count": count,
+            "latency": latency,
+            "failed": failed,
+            "error_code": codes,
+        }
+
+
+def tape_id(seed: int, distribution: Optional[LatencyDistribution], fail_rate: float, error_codes: List[int]) -> str:
+    params = {}
+    if distribution is not None:
+        params = {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in vars(distribution).items()}
+    raw = json.dumps([seed, params, fail_rate, sorted(error_codes or [500])], sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+_tapes: "OrderedDict[str, DecisionTape]" = OrderedDict()
+_tapes_lock = threading.Lock()
+
+
+def get_tape(seed: int, distribution: Optional[LatencyDistribution], fail_rate: float, error_codes: List[int]) -> DecisionTape:
+    """Shared tape for a seed and chaos config; created on first use."""
+    tid = tape_id(seed, distribution, fail_rate, error_codes)
+    with _tapes_lock:
+        tape = _tapes.get(tid)
+        if tape is None:
+            tape = _tapes[tid] = DecisionTape(seed, distribution, fail_rate, error_codes)
+            if len(_tapes) > MAX_TAPES:
+                _tapes.popitem(last=False)
+        else:
+            _tapes.move_to_end(tid)
+        return tape
+
+
+def find_tape(tid: str) -> Optional[DecisionTape]:
+    return _tapes.get(tid)
+
+
+def list_tapes() -> list:
+    return [{"id": t.id, "config": t.config(), "position": t.position} for t in list(_tapes.values())]
@@ -0,0 +1,103 @@
+import asyncio
+import math
+from typing import List, Optional, Tuple
+
+WHEEL_TICK_MS = 1
+WHEEL_SLOTS = 4096
+
+
+class TimingWheel:
+    """Hashed timing wheel for injected delays.
+
+    Every parked request goes into the slot of its deadline tick instead of
+    getting its own timer on the event loop heap. The wheel keeps a single
+    loop.call_at handle, armed for the next non-empty slot, and resolves all
+    futures due in a tick in one callback.
+    """
+
+    def __init__(self, tick_ms: int = WHEEL_TICK_MS, slots: int = WHEEL_SLOTS):
+        self.tick = tick_ms / 1000
+        self.slots: List[List[Tuple[int, asyncio.Future]]] = [[] for _ in range(slots)]
+        self.pending = 0
+        self.wakeups = 0
+        self._size = slots
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._start = 0.0
+        self._processed = 0  # next tick to expire
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._handle_tick = -1
+
+    def _current_tick(self) -> int:
+        return int((self._loop.time() - self._start) / self.tick)
+
+    def sleep(self, delay_ms: float) -> "asyncio.Future":
+        """Awaitable that completes after delay_ms (rounded up to the tick)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._bind(loop)
+        future = loop.create_future()
+        if delay_ms <= 0:
+            future.set_result(None)
+            return future
+        if not self.pending:
+            # Idle wheel: skip the elapsed ticks instead of stepping through them in _expire
+            self._processed = self._current_tick()
+        target = max(self._current_tick(), self._processed) + max(1, math.ceil(delay_ms / 1000 / self.tick))
+        self.slots[target % self._size].append((target, future))
+        self.pending += 1
+        if self._handle is None or target < self._handle_tick:
+            self._arm(target)
+        return future
+
+    def _bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        # Futures belong to one loop; a new loop (tests, reload) starts a fresh wheel
+        self.slots = [[] for _ in range(self._size)]
+        self.pending = 0
+        self._loop = loop
+        self._start = loop.time()
+        self._processed = 0
+        self._handle = None
+        self._handle_tick = -1
+
+    def _arm(self, tick: int) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle_tick = tick
+        self._handle = self._loop.call_at(self._start + tick * self.tick, self._expire)
+
+    def _expire(self) -> None:
+        self._handle = None
+        self._handle_tick = -1
+        self.wakeups += 1
+        now = self._current_tick()
+        slots, size = self.slots, self._size
+        while self._processed <= now:
+            if not self.pending:
+                self._processed = now + 1
+                break
+            tick = self._processed
+            bucket = slots[tick % size]
+            if bucket:
+                keep = []
+                for entry in bucket:
+                    if entry[0] <= tick:
+                        self.pending -= 1
+                        if not entry[1].done():
+                            entry[1].set_result(None)
+                    else:
+                        keep.append(entry)
+                slots[tick % size] = keep
+            self._processed += 1
+        if self.pending:
+            self._arm(self._next_busy_tick())
+
+    def _next_busy_tick(self) -> int:
+        # At most one revolution ahead: any later entry lives in one of these slots
+        slots, size = self.slots, self._size
+        for tick in range(self._processed, self._processed + size):
+            if slots[tick % size]:
+                return tick
+        return self._processed + size
+
+    def stats(self) -> dict:
+        return {"tick_ms": self.tick * 1000, "slots": self._size, "pending": self.pending, "wakeups": self.wakeups}
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Upstream pool configuration (override via environment)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "100"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_PER_HOST_LIMIT = int(os.getenv("UPSTREAM_PER_HOST_LIMIT", "50"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+# Upstream origins tracked (slot + stats); the least recently used idle ones are evicted past this
+UPSTREAM_MAX_HOSTS = int(os.getenv("UPSTREAM_MAX_HOSTS", "1024"))
+
+
+def _origin(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}".lower()
+
+
+class _HostStats:
+    __slots__ = ("in_flight", "waiting", "requests", "errors")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.errors = 0
+
+
+class UpstreamResponse:
+    """Streamed upstream response that holds its host slot until closed."""
+
+    def __init__(self, pool: "UpstreamPool", origin: str, response: httpx.Response):
+        self.pool = pool
+        self.origin = origin
+        self.response = response
+        self._closed = False
+        self._error = False
+
+    def aiter_raw(self):
+        """Yield the undecoded upstream body; closes the response when done or abandoned."""
+        return self._iterate(self.response.aiter_raw())
+
+    async def _iterate(self, chunks):
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception:
+            self._error = True
+            raise
+        finally:
+            await self.aclose()
+
+    async def aread(self) -> bytes:
+        try:
+            return await self.response.aread()
+        except Exception:
+            self._error = True
+            raise
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self.response.aclose()
+        finally:
+            self.pool.release(self.origin, error=self._error)
+
+
+class UpstreamPool:
+    """Shared keep-alive httpx client with a per-upstream-host concurrency cap."""
+
+    def __init__(
+        self,
+        max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive: int = UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry: float = UPSTREAM_KEEPALIVE_EXPIRY,
+        per_host_limit: int = UPSTREAM_PER_HOST_LIMIT,
+        http2: bool = UPSTREAM_HTTP2,
+        timeout: float = UPSTREAM_TIMEOUT,
+        max_hosts: int = UPSTREAM_MAX_HOSTS,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.per_host_limit = per_host_limit
+        self.http2 = http2
+        self.timeout = timeout
+        self.max_hosts = max_hosts
+        self.client: Optional[httpx.AsyncClient] = None
+        # Target URLs are user-controlled: both maps are bounded by max_hosts (LRU order)
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self._hosts: "OrderedDict[str, _HostStats]" = OrderedDict()
+
+    async def start(self) -> None:
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("UPSTREAM_HTTP2 set but the h2 package is missing; using HTTP/1.1")
+                http2 = False
+        self.http2 = http2
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(self.timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _host(self, origin: str):
+        slot = self._slots.get(origin)
+        if slot is None:
+            self._evict_idle()
+            slot = self._slots[origin] = asyncio.Semaphore(self.per_host_limit)
+            self._hosts[origin] = _HostStats()
+        else:
+            self._hosts.move_to_end(origin)
+        return slot, self._hosts[origin]
+
+    def _evict_idle(self) -> None:
+        """Forget least recently used origins with nothing in flight or waiting until below max_hosts."""
+        excess = len(self._hosts) - self.max_hosts + 1
+        if excess <= 0:
+            return
+        for origin in [o for o, s in self._hosts.items() if not s.in_flight and not s.waiting][:excess]:
+            del self._hosts[origin]
+            del self._slots[origin]
+
+    async def acquire(self, url: str) -> str:
+        """Wait for a free slot on the URL's upstream host. Returns the origin to pass to release()."""
+        origin = _origin(url)
+        slot, stats = self._host(origin)
+        stats.waiting += 1
+        try:
+            await slot.acquire()
+        finally:
+            stats.waiting -= 1
+        stats.in_flight += 1
+        stats.requests += 1
+        return origin
+
+    def release(self, origin: str, error: bool = False) -> None:
+        stats = self._hosts[origin]
+        stats.in_flight -= 1
+        if error:
+            stats.errors += 1
+        self._slots[origin].release()
+
+    async def open(self, method: str, url: str, **kwargs) -> UpstreamResponse:
+        """Send a request and return once headers arrive; the body is left unread.
+
+        Raises httpx.InvalidURL before taking a slot if the URL cannot be parsed.
+        """
+        request = self.client.build_request(method, url, **kwargs)
+        origin = await self.acquire(url)
+        try:
+            response = await self.client.send(request, stream=True)
+        except BaseException:
+            self.release(origin, error=True)
+            raise
+        return UpstreamResponse(self, origin, response)
+
+    def _connection_stats(self) -> dict:
+        # httpcore does not expose pool stats publicly; read them best-effort.
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", None) or [])
+        by_host: Dict[str, int] = {}
+        idle = 0
+        for conn in connections:
+            try:
+                if conn.is_idle():
+                    idle += 1
+                origin = getattr(conn, "_origin", None)
+                if origin is not None:
+                    host = f"{origin.scheme.decode()}://{origin.host.decode()}:{origin.port}"
+                    by_host[host] = by_host.get(host, 0) + 1
+            except Exception:
+                continue
+        return {"open": len(connections), "idle": idle, "by_host": by_host}
+
+    def stats(self) -> dict:
+        return {
+            "http2": self.http2,
+            "limits": {
+                "max_connections": self.max_connections,
+                "max_keepalive": self.max_keepalive,
+                "keepalive_expiry": self.keepalive_expiry,
+                "per_host": self.per_host_limit,
+            },
+            "connections": self._connection_stats() if self.client is not None else None,
+            "hosts": {
+                origin: {
+                    "in_flight": s.in_flight,
+                    "waiting": s.waiting,
+                    "requests": s.requests,
+                    "errors": s.errors,
+                }
+                for origin, s in self._hosts.items()
+            },
+        }
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Integer, MetaData, SmallInteger, Table, insert
+from sqlalchemy.engine import Engine
+
+from .db import get_engine
+
+logger = logging.getLogger(__name__)
+
+# Usage writer configuration (override via environment)
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "1000"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1"))
+USAGE_MAX_PENDING = int(os.getenv("USAGE_MAX_PENDING", "100000"))
+# How long a request may wait for buffer space before its event is dropped
+USAGE_MAX_WAIT = float(os.getenv("USAGE_MAX_WAIT", "0.05"))
+USAGE_RETRY_DELAY = 1.0
+USAGE_MAX_RETRY_DELAY = 30.0
+
+usage_log = Table(
+    "usage_log",
+    MetaData(),
+    Column("id", BigInteger, primary_key=True),
+    Column("config_api_key_id", Integer),
+    Column("requested_at", DateTime),
+    Column("injected_ms", Integer),
+    Column("upstream_ms", Integer),
+    Column("status_code", SmallInteger),
+    Column("failed", Boolean),
+)
+
+# (config_api_key_id, requested_at, injected_ms, upstream_ms, status_code, failed)
+UsageEvent = Tuple[int, datetime, Optional[int], Optional[int], Optional[int], bool]
+
+
+class UsageWriter:
+    """Buffers usage events (key, time and outcome) and writes them as multi-row INSERTs.
+
+    A batch is flushed when it reaches batch_size or every flush_interval
+    seconds, whichever comes first. The buffer holds at most max_pending
+    events: when it is full, record() waits up to max_wait for the writer to
+    drain it and then drops the event, so a slow database cannot grow memory
+    without bound or stall requests for long.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = USAGE_BATCH_SIZE,
+        flush_interval: float = USAGE_FLUSH_INTERVAL,
+        max_pending: int = USAGE_MAX_PENDING,
+        max_wait: float = USAGE_MAX_WAIT,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self._pending: List[UsageEvent] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Event] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._engine: Optional[Engine] = None
+
+    async def start(self) -> None:
+        self._wake = asyncio.Event()
+        self._space = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the flush loop and write whatever is still buffered."""
+        if self._task is None:
+            return
+        # Let an in-progress insert finish rather than cancelling it mid-batch
+        self._stop.set()
+        self._wake.set()
+        await self._task
+        self._task = None
+        if not await self._flush():
+            logger.warning("Usage writer: dropping %d unwritten events on shutdown", len(self._pending))
+            self.dropped += len(self._pending)
+            self._pending = []
+
+    async def record(
+        self,
+        config_api_key_id: int,
+        requested_at: Optional[datetime] = None,
+        injected_ms: Optional[int] = None,
+        upstream_ms: Optional[int] = None,
+        status_code: Optional[int] = None,
+        failed: bool = False,
+    ) -> bool:
+        """Queue one usage event. Returns False if it was dropped because the buffer stayed full.
+
+        injected_ms is the chaos delay, upstream_ms the time until the upstream
+        response headers (None when the request never reached upstream).
+        """
+        event = (config_api_key_id, requested_at or datetime.utcnow(), injected_ms, upstream_ms, status_code, failed)
+        if len(self._pending) >= self.max_pending:
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+        return self._append(event)
+
+    def record_nowait(
+        self,
+        config_api_key_id: int,
+        requested_at: Optional[datetime] = None,
+        injected_ms: Optional[int] = None,
+        upstream_ms: Optional[int] = None,
+        status_code: Optional[int] = None,
+        failed: bool = False,
+    ) -> bool:
+        """Like record() but never waits for buffer space: the event is dropped at once if the buffer is full.
+
+        Used on the request path, so a slow database never adds latency to proxied requests.
+        """
+        return self._append((config_api_key_id, requested_at or datetime.utcnow(), injected_ms, upstream_ms, status_code, failed))
+
+    def _append(self, event: UsageEvent) -> bool:
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        self._pending.append(event)
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+        return True
+
+    async def _run(self) -> None:
+        delay = USAGE_RETRY_DELAY
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stop.is_set() or not self._pending:
+                continue
+            if await self._flush():
+                delay = USAGE_RETRY_DELAY
+                continue
+            # Back off while the database is failing; only shutdown cuts the wait short
+            try:
+                await asyncio.wait_for(self._stop.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, USAGE_MAX_RETRY_DELAY)
+
+    async def _flush(self) -> bool:
+        """Write everything buffered, one batch at a time. Returns False if the database failed."""
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            try:
+                await asyncio.to_thread(self._insert, batch)
+            except Exception as e:
+                # Keep the events buffered; they are retried after a backoff
+                self.errors += 1
+                logger.warning("Usage writer: insert of %d events failed: %s", len(batch), e)
+                return False
+            del self._pending[:len(batch)]
+            self.written += len(batch)
+            self.batches += 1
+            self._space.set()
+        return True
+
+    def _insert(self, batch: List[UsageEvent]) -> None:
+        if self._engine is None:
+            self._engine = get_engine()
+        rows = [
+            {
+                "config_api_key_id": key_id,
+                "requested_at": at,
+                "injected_ms": injected_ms,
+                "upstream_ms": upstream_ms,
+                "status_code": status_code,
+                "failed": failed,
+            }
+            for key_id, at, injected_ms, upstream_ms, status_code, failed in batch
+        ]
+        with self._engine.begin() as conn:
+            # One INSERT ... VALUES (...), (...), ... statement per batch
+            conn.execute(insert(usage_log).values(rows))
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "max_pending": self.max_pending,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
@@ -1,8 +1,40 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .routers import auth, proxy, collections, endpoints, tunnels
+from .core.cache import ResponseCache
+from .core.coalesce import SingleFlight
+from .core.keystore import KeyStore
+from .core.timing_wheel import TimingWheel
+from .core.upstream import UpstreamPool
+from .core.usage import UsageWriter
+from .routers import auth, proxy, collections, endpoints, tunnels, config_keys
 
-app = FastAPI(title="LatencyPoison", description="Network Chaos Proxy")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled upstream client per worker, shared by every proxied request
+    app.state.upstream = UpstreamPool()
+    # Injected delays share one timer wheel instead of one loop timer each
+    app.state.wheel = TimingWheel()
+    # Opt-in (cache=true) upstream response cache, optionally backed by RESPONSE_CACHE_DIR
+    app.state.cache = ResponseCache()
+    # Opt-in (coalesce=true) sharing of identical in-flight upstream fetches
+    app.state.single_flight = SingleFlight()
+    # Active config keys held in memory for /{api_key}; refreshed when the table changes
+    app.state.keystore = KeyStore()
+    # Usage events for config keys, written to usage_log in batches
+    app.state.usage = UsageWriter()
+    await app.state.upstream.start()
+    await app.state.keystore.start()
+    await app.state.usage.start()
+    try:
+        yield
+    finally:
+        await app.state.usage.close()
+        await app.state.keystore.close()
+        await app.state.cache.close()
+        await app.state.upstream.close()
+
+app = FastAPI(title="LatencyPoison", description="Network Chaos Proxy", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -27,10 +59,15 @@ async def root():
         "description": "Network Chaos Proxy",
         "endpoints": {
             "/proxy": "Forward requests with configurable latency and failure rate",
+            "/proxy/stats": "Upstream pool, delay scheduler, response cache and coalescing statistics",
             "/api/auth": "Authentication endpoints",
             "/api/collections": "Collections endpoints",
             "/api/endpoints": "Endpoints endpoints",
             "/api/tunnels": "Proxy tunnels endpoints",
+            "/{api_key}/{path}": "Forward to a config key's target URL with its chaos settings",
             "/docs": "API documentation"
         }
-    } 
\ No newline at end of file
+    }
+
+# Config key proxy (/{api_key}/...) matches any path, so it is registered last
+app.include_router(config_keys.router)
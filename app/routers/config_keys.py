@@ -0,0 +1,115 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from starlette.background import BackgroundTask
+from datetime import datetime
+from http import HTTPStatus
+import asyncio
+import httpx
+import random
+import time
+
+from ..core.keystore import KeyStore
+from ..core.shaping import TokenBucket
+from ..core.timing_wheel import TimingWheel
+from ..core.upstream import UpstreamPool
+from ..core.usage import UsageWriter
+from .proxy import PROXY_METHODS, forward_headers, get_keystore, get_upstream, get_usage, get_wheel, has_request_body, stream_body
+
+# Catch-all /{api_key} routes: include this router last so it never shadows other paths
+router = APIRouter(tags=["config keys"])
+
+# Status recorded for requests whose client disconnected before a response (nginx convention)
+CLIENT_CLOSED_REQUEST = 499
+
+def failure_response(code: int) -> Response:
+    """Plain-text error reply for an injected failure."""
+    try:
+        phrase = HTTPStatus(code).phrase
+    except ValueError:
+        phrase = "Error"
+    return Response(phrase, status_code=code, media_type="text/plain")
+
+@router.api_route("/{api_key}", methods=PROXY_METHODS, include_in_schema=False)
+@router.api_route("/{api_key}/{path:path}", methods=PROXY_METHODS, include_in_schema=False)
+async def config_key_proxy(
+    request: Request,
+    api_key: str,
+    path: str = "",
+    keystore: KeyStore = Depends(get_keystore),
+    upstream: UpstreamPool = Depends(get_upstream),
+    wheel: TimingWheel = Depends(get_wheel),
+    usage: UsageWriter = Depends(get_usage),
+):
+    """Forward /{api_key}/{path} to the key's target_url + /path with the key's chaos settings."""
+    # Resolved from the in-memory snapshot; no database query per request
+    key = keystore.get(api_key)
+    if key is None:
+        raise HTTPException(status_code=401, detail="Invalid or inactive API key")
+    if not key.target_url:
+        raise HTTPException(status_code=400, detail="Config key has no target URL. Set target_url in Configs.")
+    if not key.valid_target:
+        raise HTTPException(status_code=400, detail="target_url must use http or https scheme")
+    if key.method != "ANY" and key.method != request.method:
+        raise HTTPException(status_code=405, detail=f"Method {request.method} not allowed (config method: {key.method})")
+
+    url = key.target_url
+    if path:
+        url = f"{url}/{path.lstrip('/')}"
+    if request.url.query:
+        url = f"{url}?{request.url.query}"
+
+    chaos_headers = {"X-Latency-Poison-Fail-Rate": str(round(key.fail_rate * 100))}
+    if key.chaos_seed is not None:
+        tape = key.tape()
+        decision = tape.next()
+        latency, failed, error_code = decision.latency, decision.failed, decision.error_code
+        chaos_headers.update({"X-Chaos-Tape": tape.id, "X-Chaos-Index": str(decision.index)})
+    else:
+        latency = key.sampler.next() if key.sampler is not None else 0
+        failed = key.fail_rate > 0 and random.random() < key.fail_rate
+        error_code = random.choice(key.error_codes) if failed else 0
+
+    # Every request counts as usage, including injected failures; the event is
+    # queued without waiting (dropped if the buffer is full) once the outcome
+    # (status, upstream time) is known, and written in batches
+    requested_at = datetime.utcnow()
+    injected_ms = round(latency) if latency > 0 else 0
+    if latency > 0:
+        try:
+            await wheel.sleep(latency)
+        except asyncio.CancelledError:
+            # Client went away during the injected delay: still counted, as 499 (client closed request)
+            usage.record_nowait(key.id, requested_at, injected_ms, None, CLIENT_CLOSED_REQUEST, failed)
+            raise
+    if failed:
+        recorded = usage.record_nowait(key.id, requested_at, injected_ms, None, error_code, True)
+        chaos_headers["X-Latency-Poison-Usage-Recorded"] = "1" if recorded else "0"
+        failure = failure_response(error_code)
+        failure.headers.update(chaos_headers)
+        return failure
+
+    bucket = TokenBucket(key.bandwidth, jitter=key.bandwidth_jitter) if key.bandwidth else None
+    started = time.monotonic()
+    try:
+        upstream_response = await upstream.open(
+            request.method,
+            url,
+            headers=forward_headers(request),
+            content=request.stream() if has_request_body(request) else None,
+        )
+    except httpx.InvalidURL as e:
+        # A stored target_url that passed the scheme check but that httpx cannot parse
+        usage.record_nowait(key.id, requested_at, injected_ms, None, 400)
+        raise HTTPException(status_code=400, detail=f"Invalid target URL: {str(e)}")
+    except httpx.RequestError as e:
+        usage.record_nowait(key.id, requested_at, injected_ms, round((time.monotonic() - started) * 1000), 502)
+        raise HTTPException(status_code=502, detail=f"Error forwarding request: {str(e)}")
+    response = upstream_response.response
+    upstream_ms = round((time.monotonic() - started) * 1000)
+    recorded = usage.record_nowait(key.id, requested_at, injected_ms, upstream_ms, response.status_code)
+    chaos_headers["X-Latency-Poison-Usage-Recorded"] = "1" if recorded else "0"
+    streaming = stream_body(
+        response.status_code, response.headers.raw, upstream_response.aiter_raw(), bucket,
+        background=BackgroundTask(upstream_response.aclose),
+    )
+    streaming.raw_headers.extend((k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in chaos_headers.items())
+    return streaming
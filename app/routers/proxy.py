@@ -1,13 +1,78 @@
-from fastapi import APIRouter, HTTPException, Query
-from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from typing import List, Optional
 import httpx
 import random
-import asyncio
+import time
 from urllib.parse import urlparse
 from datetime import datetime
+from ..core.cache import ResponseCache, parse_cache_control
+from ..core.coalesce import COALESCE_METHODS, SharedResponse, SingleFlight, coalesce_key
+from ..core.distributions import DISTRIBUTIONS, get_sampler, parse_params
+from ..core.keystore import KeyStore
+from ..core.shaping import TokenBucket, kbps_to_bytes, paced
+from ..core.tape import find_tape, get_tape, list_tapes
+from ..core.timing_wheel import TimingWheel
+from ..core.upstream import UpstreamPool
+from ..core.usage import UsageWriter
 
 router = APIRouter(tags=["proxy"])
 
+# Connection-scoped headers that must not be relayed (RFC 9110 section 7.6.1)
+HOP_BY_HOP_HEADERS = frozenset({
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade",
+})
+
+PROXY_METHODS = ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+
+def forward_headers(request: Request, decoded: bool = False) -> list:
+    """Client request headers to send upstream (minus Host and hop-by-hop ones).
+
+    decoded: the body is decoded here (JSON envelope), so the client's
+    Accept-Encoding is dropped and httpx offers only encodings it can decode.
+    """
+    skip = (b"host", b"expect", b"accept-encoding") if decoded else (b"host", b"expect")
+    return [
+        (name, value)
+        for name, value in request.headers.raw
+        if name.lower().decode("latin-1") not in HOP_BY_HOP_HEADERS
+        and name.lower() not in skip
+    ]
+
+def has_request_body(request: Request) -> bool:
+    if request.headers.get("transfer-encoding", "").lower() == "chunked":
+        return True
+    try:
+        return int(request.headers.get("content-length") or 0) > 0
+    except ValueError:
+        return False
+
+def get_upstream(request: Request) -> UpstreamPool:
+    """Shared upstream pool created in the app lifespan."""
+    return request.app.state.upstream
+
+def get_wheel(request: Request) -> TimingWheel:
+    """Delay scheduler created in the app lifespan."""
+    return request.app.state.wheel
+
+def get_cache(request: Request) -> ResponseCache:
+    """Upstream response cache created in the app lifespan."""
+    return request.app.state.cache
+
+def get_single_flight(request: Request) -> SingleFlight:
+    """Coalescer for identical in-flight upstream requests, created in the app lifespan."""
+    return request.app.state.single_flight
+
+def get_keystore(request: Request) -> KeyStore:
+    """Config key snapshot created in the app lifespan."""
+    return request.app.state.keystore
+
+def get_usage(request: Request) -> UsageWriter:
+    """Batched usage_log writer created in the app lifespan."""
+    return request.app.state.usage
+
 def validate_url(url: str) -> bool:
     """Validate that the URL is properly formatted and uses http/https."""
     try:
@@ -16,13 +81,90 @@ def validate_url(url: str) -> bool:
     except:
         return False
 
-@router.get("/proxy")
+def relay_headers(raw_headers) -> list:
+    """Upstream headers minus hop-by-hop ones; repeated headers (e.g. Set-Cookie) are kept."""
+    return [
+        (name, value)
+        for name, value in raw_headers
+        if name.lower().decode("latin-1") not in HOP_BY_HOP_HEADERS
+    ]
+
+def stream_body(status_code: int, raw_headers, body, bucket: Optional[TokenBucket] = None, background=None) -> StreamingResponse:
+    """Relay status, headers and raw body chunks without buffering, optionally rate limited."""
+    if bucket is not None:
+        body = paced(body, bucket)
+    streaming = StreamingResponse(body, status_code=status_code, background=background)
+    # Keep the upstream encoding/length as-is
+    streaming.raw_headers = relay_headers(raw_headers)
+    return streaming
+
+def envelope(status_code: int, raw_headers, body: bytes) -> dict:
+    """JSON envelope of a response; the body is decoded per its Content-Encoding and charset."""
+    decoded = httpx.Response(status_code, headers=raw_headers, content=body)
+    return {
+        "status_code": status_code,
+        "headers": dict(httpx.Headers(raw_headers)),
+        "content": decoded.text
+    }
+
+async def single_chunk(body: bytes):
+    yield body
+
+async def tee_to_cache(chunks, cache: ResponseCache, request: Request, url: str, status_code: int, raw_headers, ttl: float):
+    """Pass chunks through and store the body once it has been read completely."""
+    body = bytearray()
+    keep = True
+    async for chunk in chunks:
+        if keep:
+            body += chunk
+            if len(body) > cache.max_entry_bytes:
+                keep = False
+                body = bytearray()
+        yield chunk
+    if keep:
+        await cache.put(request.method, url, request.headers, status_code, list(raw_headers), bytes(body), ttl)
+
+async def fetch_shared(upstream: UpstreamPool, method: str, url: str, headers: list, max_bytes: int) -> Optional[SharedResponse]:
+    """Read a whole upstream response so it can be handed to every coalesced caller.
+
+    Returns None once the body exceeds max_bytes; the callers then stream
+    their own upstream requests instead of buffering a large download.
+    """
+    upstream_response = await upstream.open(method, url, headers=headers)
+    try:
+        body = bytearray()
+        async for chunk in upstream_response.aiter_raw():
+            body += chunk
+            if len(body) > max_bytes:
+                return None
+    finally:
+        await upstream_response.aclose()
+    response = upstream_response.response
+    return SharedResponse(response.status_code, list(response.headers.raw), bytes(body))
+
+@router.api_route("/proxy", methods=PROXY_METHODS)
 async def proxy(
+    request: Request,
+    reply: Response,
     url: str = Query(..., description="The destination URL to forward to"),
     min_latency: Optional[int] = Query(0, description="Minimum latency in milliseconds"),
     max_latency: Optional[int] = Query(0, description="Maximum latency in milliseconds"),
+    distribution: Optional[str] = Query("uniform", description=f"Latency distribution: {', '.join(DISTRIBUTIONS)}"),
+    distribution_params: Optional[str] = Query(None, description="JSON object of distribution parameters"),
     fail_rate: Optional[float] = Query(0.0, description="Probability of returning a 500 error (0.0 to 1.0)"),
-    sandbox: Optional[bool] = Query(False, description="Enable sandbox mode to return mock data")
+    error_codes: Optional[List[int]] = Query(None, description="Status codes to pick from when failing (default 500)"),
+    seed: Optional[int] = Query(None, description="Replay the deterministic decision tape for this seed"),
+    sandbox: Optional[bool] = Query(False, description="Enable sandbox mode to return mock data"),
+    raw: Optional[bool] = Query(False, description="Stream the upstream response as-is instead of a JSON envelope"),
+    bandwidth_kbps: Optional[int] = Query(0, description="Limit the response body to this many kbit/s (0 = unlimited)"),
+    bandwidth_jitter: Optional[int] = Query(0, description="Random +/- variation of the bandwidth limit in percent (0 to 100)"),
+    cache: Optional[bool] = Query(False, description="Serve GET/HEAD from the upstream response cache when fresh"),
+    cache_ttl: Optional[int] = Query(None, description="Cache lifetime in seconds when the upstream sends no freshness info"),
+    coalesce: Optional[bool] = Query(False, description="Share one upstream fetch between concurrent identical GET/HEAD/OPTIONS requests"),
+    upstream: UpstreamPool = Depends(get_upstream),
+    wheel: TimingWheel = Depends(get_wheel),
+    response_cache: ResponseCache = Depends(get_cache),
+    single_flight: SingleFlight = Depends(get_single_flight)
 ):
     # Validate URL
     if not validate_url(url):
@@ -31,6 +173,11 @@ async def proxy(
     # Validate fail_rate
     if not 0 <= fail_rate <= 1:
         raise HTTPException(status_code=400, detail="fail_rate must be between 0.0 and 1.0")
+    codes = error_codes or [500]
+    if any(c < 400 or c > 599 for c in codes):
+        raise HTTPException(status_code=400, detail="error_codes must be HTTP error status codes 400-599")
+    if seed is not None and seed < 0:
+        raise HTTPException(status_code=400, detail="seed must be a non-negative integer")
     
     # Validate latency range
     if min_latency < 0 or max_latency < 0:
@@ -38,15 +185,42 @@ async def proxy(
     if min_latency > max_latency:
         raise HTTPException(status_code=400, detail="min_latency must be less than or equal to max_latency")
     
-    # Apply random latency within range
-    latency = 0
+    # Validate bandwidth shaping
+    if bandwidth_kbps < 0:
+        raise HTTPException(status_code=400, detail="bandwidth_kbps must be zero or positive")
+    if not 0 <= bandwidth_jitter <= 100:
+        raise HTTPException(status_code=400, detail="bandwidth_jitter must be between 0 and 100")
+    if cache_ttl is not None and cache_ttl < 0:
+        raise HTTPException(status_code=400, detail="cache_ttl must be zero or positive")
+    
+    # Resolve the latency distribution (samplers are shared and refilled in bulk)
+    sampler = None
     if max_latency > 0:
-        latency = random.randint(min_latency, max_latency)
-        await asyncio.sleep(latency / 1000)
+        try:
+            sampler = get_sampler(distribution, min_latency, max_latency, parse_params(distribution_params))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    # Draw this request's chaos: from the seeded tape when replaying, otherwise live
+    chaos_headers = {}
+    if seed is not None:
+        tape = get_tape(seed, sampler.distribution if sampler else None, fail_rate, codes)
+        decision = tape.next()
+        latency, failed, error_code = decision.latency, decision.failed, decision.error_code
+        chaos_headers = {"X-Chaos-Tape": tape.id, "X-Chaos-Index": str(decision.index)}
+    else:
+        latency = sampler.next() if sampler is not None else 0
+        failed = random.random() < fail_rate
+        error_code = random.choice(codes) if failed else 0
+    
+    # Apply random latency within range
+    if latency > 0:
+        await wheel.sleep(latency)
     
     # Check if we should fail
-    if random.random() < fail_rate:
-        raise HTTPException(status_code=500, detail="Random failure injected")
+    if failed:
+        raise HTTPException(status_code=error_code, detail="Random failure injected", headers=chaos_headers or None)
+    reply.headers.update(chaos_headers)
     
     # In sandbox mode, return mock data
     if sandbox:
@@ -59,21 +233,150 @@ async def proxy(
                 "latency": {
                     "min": min_latency,
                     "max": max_latency,
-                    "actual": latency if max_latency > 0 else 0
+                    "actual": latency if max_latency > 0 else 0,
+                    "distribution": distribution
                 },
                 "fail_rate": fail_rate,
                 "timestamp": datetime.utcnow().isoformat()
             }
         }
     
-    # Forward the request
-    async with httpx.AsyncClient() as client:
+    bucket = None
+    if bandwidth_kbps > 0:
+        bucket = TokenBucket(kbps_to_bytes(bandwidth_kbps), jitter=bandwidth_jitter / 100)
+    extra_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in chaos_headers.items()]
+    
+    # Serve from the response cache when enabled and fresh (chaos above still applies)
+    request_cc = parse_cache_control(request.headers.get("cache-control")) if cache else {}
+    use_cache = cache and request.method in ("GET", "HEAD") and "no-store" not in request_cc
+    if use_cache and "no-cache" not in request_cc:
+        entry = await response_cache.get(request.method, url, request.headers)
+        if entry is not None:
+            hit_headers = [(b"age", str(int(time.time() - entry.stored_at)).encode()), (b"x-cache", b"HIT")]
+            if raw:
+                streaming = stream_body(entry.status, entry.headers, single_chunk(entry.body), bucket)
+                streaming.raw_headers.extend(hit_headers + extra_headers)
+                return streaming
+            if bucket is not None:
+                async for _ in paced(single_chunk(entry.body), bucket):
+                    pass
+            reply.headers["X-Cache"] = "HIT"
+            return envelope(entry.status, entry.headers, entry.body)
+    
+    # Concurrent identical requests share one buffered upstream fetch; the
+    # latency and failure above were still drawn for each caller on its own.
+    # Bodies over max_entry_bytes are not shared: every caller streams its own.
+    shared = None
+    if coalesce and request.method in COALESCE_METHODS and not has_request_body(request):
+        headers = forward_headers(request, decoded=not raw)
         try:
-            response = await client.get(url)
-            return {
-                "status_code": response.status_code,
-                "headers": dict(response.headers),
-                "content": response.text
-            }
+            shared, follower = await single_flight.do(
+                coalesce_key(request.method, url, headers),
+                lambda: fetch_shared(upstream, request.method, url, headers, response_cache.max_entry_bytes),
+            )
         except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Error forwarding request: {str(e)}") 
\ No newline at end of file
+            raise HTTPException(status_code=500, detail=f"Error forwarding request: {str(e)}")
+    if shared is not None:
+        if use_cache and not follower:
+            ttl = response_cache.cacheable(request.method, shared.status, shared.headers, cache_ttl, request.headers)
+            if ttl and len(shared.body) <= response_cache.max_entry_bytes:
+                await response_cache.put(request.method, url, request.headers, shared.status, shared.headers, shared.body, ttl)
+        shared_headers = [(b"x-coalesced", b"1" if follower else b"0")]
+        if use_cache:
+            shared_headers.append((b"x-cache", b"MISS"))
+        if raw:
+            streaming = stream_body(shared.status, shared.headers, single_chunk(shared.body), bucket)
+            streaming.raw_headers.extend(shared_headers + extra_headers)
+            return streaming
+        if bucket is not None:
+            async for _ in paced(single_chunk(shared.body), bucket):
+                pass
+        reply.headers.update({k.decode(): v.decode() for k, v in shared_headers})
+        return envelope(shared.status, shared.headers, shared.body)
+    
+    # Forward the request over the shared keep-alive pool; a request body is
+    # streamed from the ASGI receive channel rather than read into memory.
+    try:
+        upstream_response = await upstream.open(
+            request.method,
+            url,
+            headers=forward_headers(request, decoded=not raw),
+            content=request.stream() if has_request_body(request) else None,
+        )
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Error forwarding request: {str(e)}")
+    # Until the streaming response takes it over, any exit releases the per-origin slot
+    handed_off = False
+    try:
+        response = upstream_response.response
+        chunks = upstream_response.aiter_raw()
+        if use_cache:
+            ttl = response_cache.cacheable(request.method, response.status_code, response.headers.raw, cache_ttl, request.headers)
+            if ttl:
+                chunks = tee_to_cache(chunks, response_cache, request, url, response.status_code, response.headers.raw, ttl)
+            extra_headers.append((b"x-cache", b"MISS"))
+            reply.headers["X-Cache"] = "MISS"
+        if raw:
+            streaming = stream_body(
+                response.status_code, response.headers.raw, chunks, bucket,
+                background=BackgroundTask(upstream_response.aclose),
+            )
+            streaming.raw_headers.extend(extra_headers)
+            handed_off = True
+            return streaming
+        # Envelope mode: with a bandwidth limit the upstream read is dripped so
+        # the reply takes as long as the limit implies
+        body = bytearray()
+        async for chunk in (paced(chunks, bucket) if bucket is not None else chunks):
+            body += chunk
+        return envelope(response.status_code, response.headers.raw, bytes(body))
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Error forwarding request: {str(e)}")
+    finally:
+        if not handed_off:
+            await upstream_response.aclose()
+
+@router.get("/proxy/tapes")
+async def proxy_tapes():
+    """Decision tapes created by seeded /proxy runs in this worker."""
+    return {"tapes": list_tapes()}
+
+@router.get("/proxy/tapes/{tape_id}")
+async def export_tape(
+    tape_id: str,
+    start: int = Query(0, ge=0, description="First request index to export"),
+    count: int = Query(1000, ge=1, le=1000000, description="Number of decisions to export"),
+):
+    """Export decisions of a tape (latency, failed, error_code per request index)."""
+    tape = find_tape(tape_id)
+    if tape is None:
+        raise HTTPException(status_code=404, detail="Tape not found")
+    return tape.export(start, count)
+
+@router.post("/proxy/tapes/{tape_id}/rewind")
+async def rewind_tape(tape_id: str):
+    """Restart a run from request index 0."""
+    tape = find_tape(tape_id)
+    if tape is None:
+        raise HTTPException(status_code=404, detail="Tape not found")
+    tape.rewind()
+    return {"id": tape.id, "position": tape.position}
+
+@router.get("/proxy/stats")
+async def proxy_stats(
+    upstream: UpstreamPool = Depends(get_upstream),
+    wheel: TimingWheel = Depends(get_wheel),
+    response_cache: ResponseCache = Depends(get_cache),
+    single_flight: SingleFlight = Depends(get_single_flight),
+    keystore: KeyStore = Depends(get_keystore),
+    usage: UsageWriter = Depends(get_usage),
+):
+    """Upstream pool, delay scheduler, response cache, coalescing, key snapshot and usage writer statistics."""
+    return {
+        **upstream.stats(),
+        "delays": wheel.stats(),
+        "cache": response_cache.stats(),
+        "coalesce": single_flight.stats(),
+        "config_keys": keystore.stats(),
+        "usage": usage.stats(),
+    }
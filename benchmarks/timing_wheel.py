@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Compare the proxy's timing wheel with plain asyncio.sleep for parked delays.
+Usage (from repo root):
+  python benchmarks/timing_wheel.py [--pending 10000 50000 100000] [--max-ms 5000]
+For each pending count, N coroutines sleep a random delay in [--min-ms, --max-ms].
+Reported: CPU seconds, event-loop lag seen by a 5 ms probe (p50/p99), and
+wake-up lateness of the delays themselves (p50/p99).
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.timing_wheel import TimingWheel  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(pending: int, min_ms: int, max_ms: int, use_wheel: bool, seed: int) -> dict:
+    loop = asyncio.get_running_loop()
+    wheel = TimingWheel()
+    rng = random.Random(seed)
+    delays = [rng.randint(min_ms, max_ms) for _ in range(pending)]
+    lateness = []
+    lag = []
+    done = asyncio.Event()
+
+    async def parked(delay_ms):
+        start = loop.time()
+        if use_wheel:
+            await wheel.sleep(delay_ms)
+        else:
+            await asyncio.sleep(delay_ms / 1000)
+        lateness.append((loop.time() - start) * 1000 - delay_ms)
+
+    async def probe():
+        while not done.is_set():
+            start = loop.time()
+            await asyncio.sleep(0.005)
+            lag.append((loop.time() - start) * 1000 - 5)
+
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    probe_task = asyncio.create_task(probe())
+    await asyncio.gather(*(parked(d) for d in delays))
+    done.set()
+    await probe_task
+    return {
+        "cpu_s": time.process_time() - cpu,
+        "wall_s": time.perf_counter() - wall,
+        "lag_p50": statistics.median(lag) if lag else 0.0,
+        "lag_p99": percentile(lag, 0.99),
+        "late_p50": statistics.median(lateness),
+        "late_p99": percentile(lateness, 0.99),
+        "wakeups": wheel.wakeups if use_wheel else pending,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pending", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--min-ms", type=int, default=100)
+    parser.add_argument("--max-ms", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    header = f"{'pending':>8} {'scheduler':>13} {'cpu s':>7} {'wall s':>7} {'lag p50':>8} {'lag p99':>8} {'late p50':>9} {'late p99':>9} {'wakeups':>8}"
+    print(header)
+    print("-" * len(header))
+    for pending in args.pending:
+        for use_wheel in (False, True):
+            r = asyncio.run(run(pending, args.min_ms, args.max_ms, use_wheel, args.seed))
+            name = "timing wheel" if use_wheel else "asyncio.sleep"
+            print(
+                f"{pending:>8} {name:>13} {r['cpu_s']:>7.2f} {r['wall_s']:>7.2f} {r['lag_p50']:>8.2f} "
+                f"{r['lag_p99']:>8.2f} {r['late_p50']:>9.2f} {r['late_p99']:>9.2f} {r['wakeups']:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
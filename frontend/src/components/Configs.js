@@ -78,7 +78,7 @@ function Configs() {
 
   const handleAddErrorCode = (form, setForm) => {
     const n = parseInt(errorCodeInput, 10);
-    if (isNaN(n) || n < 100 || n > 599) return;
+    if (isNaN(n) || n < 400 || n > 599) return;
     if (form.error_codes.includes(n)) return;
     setForm(f => ({ ...f, error_codes: [...f.error_codes, n].sort((a, b) => a - b) }));
     setErrorCodeInput('');
@@ -40,7 +40,7 @@ import {
   ResponsiveContainer,
   Legend,
 } from 'recharts';
-import { fetchConfigKeys, fetchUsageTimeline, fetchUsageSummary } from '../services/api';
+import { fetchConfigKeys, fetchUsageTimeline, fetchUsageSummary, openUsageLive } from '../services/api';
 
 const COLORS = ['#90caf9', '#f48fb1', '#ce93d8', '#81c784', '#ffb74d'];
 
@@ -83,6 +83,44 @@ function Dashboard() {
     return () => { cancelled = true; };
   }, [configKeys.length]);
 
+  // Live request counts on top of the summary; the stream token is only checked
+  // when the stream opens, so on any error reconnect with a fresh one
+  useEffect(() => {
+    if (!configKeys.length) return;
+    let cancelled = false;
+    let source = null;
+    let retry = null;
+    const connect = async () => {
+      try {
+        const opened = await openUsageLive((update) => {
+          const added = Object.values(update.deltas || {}).reduce((n, d) => n + (d.requests || 0), 0);
+          if (!added) return;
+          setUsageSummary((prev) => (prev && !prev.error
+            ? { ...prev, total_requests: prev.total_requests + added, requests_this_month: (prev.requests_this_month || 0) + added }
+            : prev));
+        });
+        if (cancelled) {
+          opened.close();
+          return;
+        }
+        source = opened;
+        source.onerror = () => {
+          source.close();
+          source = null;
+          if (!cancelled) retry = setTimeout(connect, 5000);
+        };
+      } catch {
+        if (!cancelled) retry = setTimeout(connect, 30000);
+      }
+    };
+    connect();
+    return () => {
+      cancelled = true;
+      clearTimeout(retry);
+      if (source) source.close();
+    };
+  }, [configKeys.length]);
+
   useEffect(() => {
     if (!configKeys.length) return;
     let cancelled = false;
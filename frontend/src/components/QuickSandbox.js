@@ -60,7 +60,7 @@ function QuickSandbox() {
 
   const handleAddErrorCode = () => {
     const n = parseInt(errorCodeInput, 10);
-    if (isNaN(n) || n < 100 || n > 599) return;
+    if (isNaN(n) || n < 400 || n > 599) return;
     if (formData.errorCodes.includes(n)) return;
     setFormData(f => ({
       ...f,
@@ -259,7 +259,7 @@ function QuickSandbox() {
               Error codes (when failure is injected)
             </Typography>
             <Typography variant="body2" color="text.secondary" sx={{ mb: 2 }}>
-              HTTP status codes (100–599) to return when a failure is triggered. One is chosen at random. Same behavior as Configs.
+              HTTP error status codes (400–599) to return when a failure is triggered. One is chosen at random. Same behavior as Configs.
             </Typography>
             <Box sx={{ display: 'flex', flexWrap: 'wrap', alignItems: 'center', gap: 1 }}>
               {(formData.errorCodes.length ? formData.errorCodes : []).map((code) => (
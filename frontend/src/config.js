@@ -21,6 +21,8 @@ export const API_ENDPOINTS = {
   },
   USAGE_TIMELINE: `${API_BASE_URL}/api/usage/timeline`,
   USAGE_SUMMARY: `${API_BASE_URL}/api/usage/summary`,
+  USAGE_LIVE: `${API_BASE_URL}/api/usage/live`,
+  USAGE_LIVE_TOKEN: `${API_BASE_URL}/api/usage/live/token`,
   BILLING: {
     PLANS: `${API_BASE_URL}/api/billing/plans`,
     USAGE: `${API_BASE_URL}/api/billing/usage`,
@@ -181,6 +181,16 @@ export const fetchUsageSummary = async () => {
   return handleResponse(response);
 };
 
+// Live usage stream (server-sent events). EventSource cannot send the Authorization
+// header, so the stream is opened with a short-lived token from the API.
+export const openUsageLive = async (onUsage) => {
+  const response = await fetch(API_ENDPOINTS.USAGE_LIVE_TOKEN, { method: 'POST', headers: getAuthHeader() });
+  const { token } = await handleResponse(response);
+  const source = new EventSource(`${API_ENDPOINTS.USAGE_LIVE}?token=${encodeURIComponent(token)}`);
+  source.addEventListener('usage', (e) => onUsage(JSON.parse(e.data)));
+  return source;
+};
+
 // Billing
 export const fetchBillingPlans = async () => {
   const response = await fetch(API_ENDPOINTS.BILLING.PLANS);
@@ -87,12 +87,16 @@ func (c *MySQLClient) Close() error {
 func EnsureUsageLogTable(db *sql.DB, logger *zap.Logger) {
 	_, err := db.Exec(`
 		CREATE TABLE IF NOT EXISTS usage_log (
-			id INT AUTO_INCREMENT PRIMARY KEY,
+			id BIGINT AUTO_INCREMENT,
 			config_api_key_id INT NOT NULL,
 			requested_at DATETIME NOT NULL,
+			injected_ms INT NULL,
+			upstream_ms INT NULL,
+			status_code SMALLINT NULL,
+			failed TINYINT(1) NOT NULL DEFAULT 0,
+			PRIMARY KEY (id, requested_at),
 			INDEX (config_api_key_id),
-			INDEX (requested_at),
-			FOREIGN KEY (config_api_key_id) REFERENCES config_api_keys(id) ON DELETE CASCADE
+			INDEX (requested_at)
 		)
 	`)
 	if err != nil {
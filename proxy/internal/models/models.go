@@ -44,7 +44,14 @@ func (r *Repository) GetConfigApiKeyByKey(key string) (*ConfigApiKey, error) {
 	}
 	c.FailRate = int(failRate)
 	if errorCodesJSON != "" && errorCodesJSON != "[]" {
-		_ = json.Unmarshal([]byte(errorCodesJSON), &c.ErrorCodes)
+		var codes []int
+		_ = json.Unmarshal([]byte(errorCodesJSON), &codes)
+		// Only HTTP error statuses are injected; older rows may hold others (e.g. 204, 302)
+		for _, code := range codes {
+			if code >= 400 && code <= 599 {
+				c.ErrorCodes = append(c.ErrorCodes, code)
+			}
+		}
 	}
 	if len(c.ErrorCodes) == 0 {
 		c.ErrorCodes = []int{500, 503}